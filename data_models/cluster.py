@@ -1,9 +1,36 @@
+import numpy as np
+
+from data_models.package_store import PackageStore
+
+
 class Cluster:
 
-    def __init__(self, cluster_id, packages, warehouse):
+    def __init__(self, cluster_id, packages, warehouse, medoid=None):
         self.cluster_id = cluster_id
-        self.packages = packages
+        # member rows of a PackageStore, `packages` gives them as Package views
+        self.store, self.indices = PackageStore.locate(packages)
         self.warehouse = warehouse
+        # most central package of the cluster, set by medoid-based clustering models
+        self.medoid = medoid
+        # packages in visiting order and the length of that tour, set by the route optimizer
+        self.route = None
+        self.route_length = None
+
+    @classmethod
+    def from_indices(cls, cluster_id, store: PackageStore, indices, warehouse, medoid=None):
+        cluster = cls(cluster_id, [], warehouse, medoid)
+        cluster.store, cluster.indices = store, np.asarray(indices, dtype=np.intp)
+        return cluster
+
+    @property
+    def packages(self):
+        return self.store.packages(self.indices)
+
+    @packages.setter
+    def packages(self, packages):
+        self.store, self.indices = PackageStore.locate(packages)
+        # a route of the previous members no longer visits them all
+        self.set_route(None, None)
 
     def get_id(self):
         return self.cluster_id
@@ -15,10 +42,14 @@ class Cluster:
         return self.packages
 
     def add_package(self, package):
-        self.packages.append(package)
+        self.add_packages([package])
 
     def add_packages(self, packages):
-        self.packages.extend(packages)
+        if len(self.indices) == 0:
+            self.packages = packages
+            return
+        self.indices = np.concatenate([self.indices, self.store.adopt(packages)])
+        self.set_route(None, None)
 
     def get_warehouse(self):
         return self.warehouse
@@ -26,28 +57,50 @@ class Cluster:
     def set_warehouse(self, warehouse):
         self.warehouse = warehouse
 
+    def get_medoid(self):
+        return self.medoid
+
+    def set_medoid(self, medoid):
+        self.medoid = medoid
+
+    def get_route(self):
+        return self.route
+
+    def get_route_length(self):
+        return self.route_length
+
+    def set_route(self, route, route_length):
+        self.route = route
+        self.route_length = route_length
+
     def set_package_cluster_at_index(self, index, cluster_id):
-        self.packages[index].set_cluster(cluster_id)
+        self.store.cluster[self.indices[index]] = cluster_id
+
+    def set_packages_cluster(self, cluster_id):
+        self.store.cluster[self.indices] = cluster_id
 
     def get_cluster_size(self):
-        return len(self.packages)
+        return len(self.indices)
 
     def remove_package_at_index(self, index):
-        self.packages.pop(index)
+        self.indices = np.delete(self.indices, index)
+        self.set_route(None, None)
 
     def remove_package(self, package):
-        self.packages.remove(package)
+        positions = np.flatnonzero(self.indices == package.index) if package.store is self.store else []
+        if len(positions) == 0:
+            raise ValueError("Cluster.remove_package(package): package not in cluster")
+        self.remove_package_at_index(positions[0])
 
     def count_packages_by_priority(self):
-        priority_counts = {0: 0, 1: 0, 2: 0, 3: 0}
-        for package in self.packages:
-            priority_counts[package.get_priority()] += 1
-        return priority_counts
+        return self.store.count_by_priority(self.indices)
 
     # each cluster has the same start and destination point, which is warehouse
     # add them for the purpose of sending requests to th Waypoint Optimization endpoint
+    # packages follow the optimized route when one was computed
     def create_waypoints(self):
-        return [self.warehouse] + self.packages + [self.warehouse]
+        stops = self.route if self.route is not None else self.packages
+        return [self.warehouse] + stops + [self.warehouse]
 
     def __str__(self):
         data = f"Cluster {self.cluster_id}\n"
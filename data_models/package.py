@@ -1,16 +1,87 @@
+from data_models.package_store import PackageStore, default_store, format_minutes, to_minutes
+
+
 class Package:
+    # view of one row of a PackageStore, packages created directly are appended to the default store
+    __slots__ = ("store", "index", "closest_package")
 
     def __init__(self, package_id, latitude, longitude, priority=0, opening_hour="", closing_hour="", cluster=-1,
-                 closest_package=None):
-        self.package_id = package_id
-        self.latitude = latitude
-        self.longitude = longitude
-        self.priority = priority
-        self.opening_hour = opening_hour
-        self.closing_hour = closing_hour
-        self.cluster = cluster
+                 closest_package=None, store: PackageStore = None):
+        self.store = default_store if store is None else store
+        self.index = self.store.add(package_id, latitude, longitude, priority, opening_hour, closing_hour, cluster)
         self.closest_package = closest_package
 
+    @classmethod
+    def view(cls, store: PackageStore, index):
+        package = cls.__new__(cls)
+        package.store = store
+        package.index = index
+        package.closest_package = None
+        return package
+
+    # two views of the same row are the same package
+    def __eq__(self, other):
+        return isinstance(other, Package) and self.store is other.store and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.store), self.index))
+
+    @property
+    def package_id(self):
+        return self.store.ids[self.index]
+
+    @package_id.setter
+    def package_id(self, package_id):
+        self.store.ids[self.index] = package_id
+
+    @property
+    def latitude(self):
+        return float(self.store.latitude[self.index])
+
+    @latitude.setter
+    def latitude(self, latitude):
+        self.store.latitude[self.index] = latitude
+
+    @property
+    def longitude(self):
+        return float(self.store.longitude[self.index])
+
+    @longitude.setter
+    def longitude(self, longitude):
+        self.store.longitude[self.index] = longitude
+
+    @property
+    def priority(self):
+        return int(self.store.priority[self.index])
+
+    @priority.setter
+    def priority(self, priority):
+        self.store.priority[self.index] = priority
+
+    @property
+    def opening_hour(self):
+        return format_minutes(int(self.store.opening_minutes[self.index]))
+
+    @opening_hour.setter
+    def opening_hour(self, opening_hour):
+        self.store.opening_minutes[self.index] = to_minutes(opening_hour)
+
+    @property
+    def closing_hour(self):
+        return format_minutes(int(self.store.closing_minutes[self.index]))
+
+    @closing_hour.setter
+    def closing_hour(self, closing_hour):
+        self.store.closing_minutes[self.index] = to_minutes(closing_hour)
+
+    @property
+    def cluster(self):
+        return int(self.store.cluster[self.index])
+
+    @cluster.setter
+    def cluster(self, cluster):
+        self.store.cluster[self.index] = cluster
+
     def get_id(self):
         return self.package_id
 
@@ -60,4 +131,4 @@ class Package:
             data["priority"] = self.priority
         if self.opening_hour and self.closing_hour:
             data["timeWindow"] = [{"opening_hour": self.opening_hour, "closing_hour": self.closing_hour}]
-        return data
\ No newline at end of file
+        return data
@@ -0,0 +1,217 @@
+import threading
+from collections.abc import Sequence
+
+import numpy as np
+
+# time windows are kept as minutes after midnight, packages without one have NO_TIME
+NO_TIME = -1
+
+
+def to_minutes(hour):
+    # "HH:MM" (or "HH:MM:SS") -> minutes after midnight, "" -> NO_TIME
+    if hour is None or hour == "":
+        return NO_TIME
+    parts = str(hour).split(":")
+    if len(parts) < 2:
+        raise ValueError(f"Time window {hour!r} is not in HH:MM format")
+    return int(parts[0]) * 60 + int(parts[1])
+
+
+def format_minutes(minutes):
+    if minutes == NO_TIME:
+        return ""
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+class PackageStore:
+    # package data as one NumPy array per field (about 25 bytes per package plus the id), Package objects are
+    # views of a row and Cluster objects hold row indices, so labelling, counting and grouping are array operations
+    COLUMNS = {
+        "latitude": np.float64,
+        "longitude": np.float64,
+        "priority": np.int8,
+        "opening_minutes": np.int16,
+        "closing_minutes": np.int16,
+        "cluster": np.int32,
+    }
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self._ids = np.empty(capacity, dtype=object)
+        self._columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in self.COLUMNS.items()}
+        # rows are appended from the thread that creates the packages, the lock only guards growing the arrays
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def __getstate__(self):
+        # only the used rows are pickled (e.g. when packages are sent to worker processes)
+        return {"ids": self.ids, "columns": {name: self.column(name) for name in self.COLUMNS}}
+
+    def __setstate__(self, state):
+        self.size = len(state["ids"])
+        self._ids = state["ids"].copy()
+        self._columns = {name: values.copy() for name, values in state["columns"].items()}
+        self._lock = threading.Lock()
+
+    @property
+    def ids(self):
+        return self._ids[:self.size]
+
+    def column(self, name):
+        return self._columns[name][:self.size]
+
+    @property
+    def latitude(self):
+        return self.column("latitude")
+
+    @property
+    def longitude(self):
+        return self.column("longitude")
+
+    @property
+    def priority(self):
+        return self.column("priority")
+
+    @property
+    def opening_minutes(self):
+        return self.column("opening_minutes")
+
+    @property
+    def closing_minutes(self):
+        return self.column("closing_minutes")
+
+    @property
+    def cluster(self):
+        return self.column("cluster")
+
+    def _reserve(self, count):
+        # grows the arrays geometrically so appending one package is amortised O(1)
+        start = self.size
+        if start + count > len(self._ids):
+            capacity = max(2 * len(self._ids), start + count)
+            self._ids = np.concatenate([self._ids[:start], np.empty(capacity - start, dtype=object)])
+            for name, values in self._columns.items():
+                grown = np.empty(capacity, dtype=values.dtype)
+                grown[:start] = values[:start]
+                self._columns[name] = grown
+        self.size = start + count
+        return start
+
+    def add(self, package_id, latitude, longitude, priority=0, opening_hour="", closing_hour="", cluster=-1):
+        # the time window is checked before a row is reserved, an invalid one leaves the store unchanged
+        opening_minutes, closing_minutes = to_minutes(opening_hour), to_minutes(closing_hour)
+        with self._lock:
+            index = self._reserve(1)
+            self._ids[index] = package_id
+            self._columns["latitude"][index] = latitude
+            self._columns["longitude"][index] = longitude
+            self._columns["priority"][index] = priority
+            self._columns["opening_minutes"][index] = opening_minutes
+            self._columns["closing_minutes"][index] = closing_minutes
+            self._columns["cluster"][index] = cluster
+        return index
+
+    def add_many(self, ids, latitudes, longitudes, priorities=None, opening_minutes=None, closing_minutes=None,
+                 clusters=None):
+        # appends whole columns at once (time windows already in minutes), returns the new row indices
+        count = len(ids)
+        defaults = {"priority": 0, "opening_minutes": NO_TIME, "closing_minutes": NO_TIME, "cluster": -1}
+        values = {"latitude": latitudes, "longitude": longitudes, "priority": priorities,
+                  "opening_minutes": opening_minutes, "closing_minutes": closing_minutes, "cluster": clusters}
+        with self._lock:
+            start = self._reserve(count)
+            self._ids[start:start + count] = ids
+            for name, column in values.items():
+                self._columns[name][start:start + count] = defaults[name] if column is None else column
+        return np.arange(start, start + count)
+
+    def package(self, index):
+        from data_models.package import Package
+        return Package.view(self, index)
+
+    def packages(self, indices=None):
+        indices = range(self.size) if indices is None else indices
+        return [self.package(int(index)) for index in indices]
+
+    def view(self, indices=None):
+        # lazy sequence of Package views, nothing is created per package until it is accessed
+        return PackageList(self, np.arange(self.size) if indices is None else indices)
+
+    def adopt(self, packages):
+        # row indices of `packages` in this store, packages of other stores are copied in and become views of it:
+        # the caller's Package objects are rebound (their store and index change), so they read and write the
+        # copied row from then on; the row in their previous store is left behind
+        indices = np.empty(len(packages), dtype=np.intp)
+        for position, package in enumerate(packages):
+            if package.store is not self:
+                with self._lock:
+                    index = self._reserve(1)
+                self._ids[index] = package.store.ids[package.index]
+                for name in self.COLUMNS:
+                    self._columns[name][index] = package.store.column(name)[package.index]
+                package.store, package.index = self, index
+            indices[position] = package.index
+        return indices
+
+    @staticmethod
+    def locate(packages, store=None):
+        # (store, row indices) of a list of packages; with a store, packages of other stores are copied into it,
+        # without one they are moved into one new store when they come from several
+        if isinstance(packages, PackageList) and (store is None or packages.store is store):
+            return packages.store, packages.indices
+        stores = {id(package.store): package.store for package in packages}
+        if not stores:
+            return default_store if store is None else store, np.empty(0, dtype=np.intp)
+        if len(stores) == 1 and (store is None or id(store) in stores):
+            store = next(iter(stores.values()))
+            return store, np.fromiter((package.index for package in packages), dtype=np.intp, count=len(packages))
+        if store is None:
+            store = PackageStore(capacity=max(len(packages), 1))
+        return store, store.adopt(packages)
+
+    def count_by_priority(self, indices, levels=4):
+        # {priority: number of packages} over the given rows, priorities 0..levels-1 are always present
+        counts = np.bincount(self.priority[indices], minlength=levels)
+        return {priority: int(count) for priority, count in enumerate(counts)}
+
+    def group_by_cluster(self, indices, n_clusters):
+        # row indices of every cluster label 0..n_clusters-1, in the order of `indices`
+        indices = np.asarray(indices)
+        labels = self.cluster[indices]
+        order = np.argsort(labels, kind="stable")
+        bounds = np.searchsorted(labels[order], np.arange(n_clusters + 1))
+        return [indices[order[bounds[label]:bounds[label + 1]]] for label in range(n_clusters)]
+
+
+class PackageList(Sequence):
+    # rows of a PackageStore used like a list of Package objects (indexing, slicing, iteration, len)
+    def __init__(self, store: PackageStore, indices):
+        self.store = store
+        self.indices = np.asarray(indices, dtype=np.intp)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return self.store.package(int(self.indices[item]))
+        return PackageList(self.store, self.indices[item])
+
+    def __iter__(self):
+        return (self.store.package(int(index)) for index in self.indices)
+
+    def __add__(self, other):
+        if isinstance(other, PackageList) and other.store is self.store:
+            return PackageList(self.store, np.concatenate([self.indices, other.indices]))
+        return list(self) + list(other)
+
+    def get_ids(self):
+        return self.store.ids[self.indices]
+
+
+# store of packages created without an explicit one (Package(...) in scripts and tests), bulk loaders
+# create a store of their own. Rows are never removed, so it grows with every package created this way for the
+# lifetime of the process: long-running services should load packages into a store of their own
+default_store = PackageStore()
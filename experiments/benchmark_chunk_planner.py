@@ -0,0 +1,69 @@
+import argparse
+import contextlib
+import io
+import time
+
+import numpy as np
+
+from data_models.package import Package
+from experiments.mock_tomtom_server import MockTomTomServer
+from services.cluster_manager import CHUNK_SIZE, ClusterManager, chunk_ranges, plan_blocks
+from services.tomtom_client import TomTomClient
+
+
+# Fixed 50 x 50 chunks against planned rectangular blocks, and the async endpoint against the synchronous one for
+# small matrices, on the local mock server with simulated job latency and cell limits
+def create_packages(num_packages, seed=42):
+    random_state = np.random.RandomState(seed)
+    return [Package(package_id=f"pkg_{i}", latitude=random_state.uniform(44.75, 44.85),
+                    longitude=random_state.uniform(20.38, 20.50)) for i in range(num_packages)]
+
+
+def fixed_blocks(num_packages):
+    chunks = list(chunk_ranges(num_packages, CHUNK_SIZE))
+    return [(slice(*rows), slice(*cols)) for rows in chunks for cols in chunks]
+
+
+def time_matrix_build(client, packages, blocks, max_concurrent_jobs):
+    cluster_manager = ClusterManager(packages, num_of_clusters=1, warehouse="W1", clustering_model=None,
+                                     tomtom_client=client, max_concurrent_jobs=max_concurrent_jobs)
+    cluster_manager.distance_matrix = np.zeros((len(packages), len(packages)))
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        cluster_manager._fetch_blocks(blocks)
+    return time.perf_counter() - start, cluster_manager.distance_matrix
+
+
+def time_small_requests(client, packages, num_destinations, repeats):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(repeats):
+            client.get_distance_matrix(packages[i:i + 1], packages[:num_destinations])
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the matrix chunk planner and sync endpoint selection")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[60, 120, 260, 510])
+    parser.add_argument("--latency", type=float, default=0.3, help="Seconds until a mock async job completes")
+    parser.add_argument("--sync_latency", type=float, default=0.02, help="Seconds of a mock synchronous request")
+    parser.add_argument("--max_concurrent_jobs", type=int, default=4)
+    args = parser.parse_args()
+
+    with MockTomTomServer(latency=args.latency, sync_latency=args.sync_latency) as server:
+        client = TomTomClient("mock", base_url=server.base_url, poll_interval=0.05)
+        for num_packages in args.sizes:
+            packages = create_packages(num_packages)
+            planned = plan_blocks(num_packages, num_packages, client.max_cells)
+            fixed_seconds, fixed_matrix = time_matrix_build(client, packages, fixed_blocks(num_packages),
+                                                            args.max_concurrent_jobs)
+            planned_seconds, planned_matrix = time_matrix_build(client, packages, planned, args.max_concurrent_jobs)
+            assert np.array_equal(fixed_matrix, planned_matrix)
+            print(f"{num_packages} packages: 50x50 chunks {len(fixed_blocks(num_packages))} jobs {fixed_seconds:.2f}s, "
+                  f"planned {len(planned)} jobs {planned_seconds:.2f}s")
+
+        packages = create_packages(20)
+        sync_seconds = time_small_requests(client, packages, 12, repeats=10)
+        client.sync_max_cells = 0
+        async_seconds = time_small_requests(client, packages, 12, repeats=10)
+        print(f"1x12 matrix: sync endpoint {1000 * sync_seconds:.0f} ms, async endpoint {1000 * async_seconds:.0f} ms")
@@ -0,0 +1,70 @@
+import argparse
+import time
+
+import numpy as np
+import requests
+
+from experiments.benchmark_chunk_planner import create_packages
+from experiments.mock_tomtom_server import MockTomTomServer
+from services.cluster_manager import ClusterManager
+from services.tomtom_client import TomTomClient
+
+
+# Job latency and matrix build throughput of TomTomClient against the local mock server: bare requests calls with
+# a fixed poll interval (the previous behaviour), the pooled session with the same fixed interval, and the pooled
+# session with adaptive polling
+def create_client(config, base_url, fixed_interval):
+    if config == "bare requests, fixed polling":
+        # the requests module has the get/post interface of a session, without the connection pool
+        return TomTomClient("mock", base_url=base_url, session=requests, poll_interval=fixed_interval,
+                            adaptive_polling=False, poll_backoff=1.0, poll_jitter=0.0)
+    if config == "session, fixed polling":
+        return TomTomClient("mock", base_url=base_url, poll_interval=fixed_interval, adaptive_polling=False,
+                            poll_backoff=1.0, poll_jitter=0.0)
+    return TomTomClient("mock", base_url=base_url)
+
+
+def time_sequential_jobs(server, client, packages, num_jobs):
+    # seconds per job, status requests per job and connections per job of one job after another
+    status_requests, connections = server.status_requests, server.connections
+    start = time.perf_counter()
+    for i in range(num_jobs):
+        client.get_distance_matrix(packages[i:i + 20], packages)
+    elapsed = time.perf_counter() - start
+    return (elapsed / num_jobs, (server.status_requests - status_requests) / num_jobs,
+            (server.connections - connections) / num_jobs)
+
+
+def time_matrix_build(server, client, packages, max_concurrent_jobs):
+    # jobs per second of a full distance matrix build
+    cluster_manager = ClusterManager(packages, num_of_clusters=1, warehouse="W1", clustering_model=None,
+                                     tomtom_client=client, max_concurrent_jobs=max_concurrent_jobs)
+    submitted_jobs = server.submitted_jobs
+    start = time.perf_counter()
+    matrix = cluster_manager.build_distance_matrix()
+    elapsed = time.perf_counter() - start
+    return (server.submitted_jobs - submitted_jobs) / elapsed, np.asarray(matrix).copy()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark connection pooling and adaptive polling of TomTomClient")
+    parser.add_argument("--latency", type=float, default=1.0, help="Seconds until a mock async job completes")
+    parser.add_argument("--fixed_interval", type=float, default=2.0, help="Poll interval of the fixed configurations")
+    parser.add_argument("--num_jobs", type=int, default=8, help="Sequential jobs of the latency test")
+    parser.add_argument("--num_packages", type=int, default=300, help="Packages of the throughput test")
+    parser.add_argument("--max_concurrent_jobs", type=int, default=4)
+    args = parser.parse_args()
+
+    packages = create_packages(args.num_packages)
+    configs = ["bare requests, fixed polling", "session, fixed polling", "session, adaptive polling"]
+    matrices = []
+    with MockTomTomServer(latency=args.latency, sync_max_cells=0) as server:
+        for config in configs:
+            client = create_client(config, server.base_url, args.fixed_interval)
+            client.sync_max_cells = 0
+            seconds, polls, connections = time_sequential_jobs(server, client, packages[:60], args.num_jobs)
+            jobs_per_second, matrix = time_matrix_build(server, client, packages, args.max_concurrent_jobs)
+            matrices.append(matrix)
+            print(f"{config}: {seconds:.2f} s per job, {polls:.1f} status requests and {connections:.1f} connections "
+                  f"per job, matrix build {jobs_per_second:.2f} jobs/s")
+    assert all(np.array_equal(matrices[0], matrix) for matrix in matrices)
@@ -0,0 +1,68 @@
+import argparse
+import contextlib
+import io
+import time
+
+import numpy as np
+
+from data_models.package import Package
+from services.cluster_manager import ClusterManager, chunk_list
+
+CHUNK_SIZE = 50
+
+
+# Returns a constant block for every job so that only the assembly of the matrix is timed
+class StaticBlockClient:
+    def __init__(self):
+        self.block = np.ones((CHUNK_SIZE, CHUNK_SIZE))
+
+    def get_distance_matrix(self, origins, destinations):
+        # planned blocks need not be square, a broadcast view costs nothing whatever their shape
+        return np.broadcast_to(self.block[0, 0], (len(origins), len(destinations)))
+
+
+def create_packages(num_packages):
+    return [Package(package_id=f"pkg_{i}", latitude=44.8, longitude=20.4) for i in range(num_packages)]
+
+
+def time_block_assembly(packages):
+    cluster_manager = ClusterManager(packages, num_of_clusters=1, warehouse="W1", clustering_model=None,
+                                     tomtom_client=StaticBlockClient(), max_concurrent_jobs=1)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        cluster_manager.build_distance_matrix()
+    elapsed = time.perf_counter() - start
+    cluster_manager.distance_matrix = None
+    return elapsed
+
+
+def time_index_assembly(packages, sample_blocks=2):
+    # the previous per-cell packages.index() loop, timed on a few blocks and extrapolated to the full grid
+    distance_matrix = np.zeros((len(packages), len(packages)), dtype=np.float32)
+    chunks = list(chunk_list(packages, CHUNK_SIZE))
+    submatrix = StaticBlockClient().block.tolist()
+
+    # blocks from the middle of the list pay the average cost of a linear index() scan
+    middle = len(chunks) // 2
+    start = time.perf_counter()
+    for origins in chunks[middle:middle + sample_blocks]:
+        for destinations in chunks[middle:middle + 1]:
+            for oi, origin in enumerate(origins):
+                for dj, destination in enumerate(destinations):
+                    distance_matrix[packages.index(origin), packages.index(destination)] = submatrix[oi][dj]
+    elapsed = time.perf_counter() - start
+    return elapsed / sample_blocks * len(chunks) ** 2
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark distance matrix assembly from TomTom submatrices")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5000, 20000])
+    args = parser.parse_args()
+
+    for num_packages in args.sizes:
+        packages = create_packages(num_packages)
+        block_seconds = time_block_assembly(packages)
+        index_seconds = time_index_assembly(packages)
+        print(f"{num_packages} packages: block writes {block_seconds:.2f}s, "
+              f"packages.index() loop ~{index_seconds:.0f}s (extrapolated), "
+              f"speed-up ~{index_seconds / block_seconds:.0f}x")
@@ -0,0 +1,181 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from experiments.mock_tomtom_server import MockTomTomServer
+from experiments.test_app import create_dummy_packages
+from models.kmedoids_clustering import KMedoidsClusteringModel
+from services.cluster_manager import ClusterManager
+from services.tomtom_client import TomTomClient
+from utils.evaluation_utils import evaluate_clusters
+from utils.instrumentation import metrics
+
+DEFAULT_BASELINE = "experiments/benchmark_baseline.json"
+STAGES = ["build_distance_matrix", "build_clusters", "evaluate"]
+
+
+# build_distance_matrix, build_clusters and evaluation at production sizes against the mock TomTom server (in a
+# process of its own, so it does not compete with the client for the GIL). Up to --dense_limit packages the full
+# matrix is fetched, larger sets go through build_partitioned_clusters. Timings are compared with a saved baseline
+# and the run fails when a stage got slower than the tolerance allows; both runs also time a fixed CPU workload and
+# the baseline is scaled by the ratio of the two, so it holds on a faster or slower machine.
+def serve_mock(ports, server_options):
+    with MockTomTomServer(**server_options) as server:
+        ports.put(server.port)
+        server.thread.join()
+
+
+def start_mock_server(server_options):
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve_mock, args=(ports, server_options), daemon=True)
+    process.start()
+    return process, ports.get(timeout=30)
+
+
+def calibrate(repeats=3):
+    # best of a few runs of a fixed workload: a k-medoids fit on the distances of 1000 random points
+    points = np.random.RandomState(0).uniform(size=(1000, 2))
+    matrix = np.sqrt(((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2))
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        KMedoidsClusteringModel(n_clusters=20, n_restarts=1).fit(matrix)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def evaluate_partitioned(distance_graph, labels, partitions):
+    # the graph of build_partitioned_clusters only holds complete blocks within partitions, every partition is
+    # scored on its own and the scores are averaged weighted by the partition size. A cluster belongs to the
+    # partition most of its members come from; packages that boundary repair moved into a cluster of another
+    # partition have no distances to the rest of that partition and are left out
+    home = np.full(labels.max() + 1, -1)
+    for label in np.unique(labels):
+        home[label] = np.bincount(partitions[labels == label]).argmax()
+    in_home = home[labels] == partitions
+    scores, weights = [], []
+    for partition in np.unique(partitions):
+        members = np.flatnonzero(in_home & (partitions == partition))
+        if len(np.unique(labels[members])) < 2:
+            continue
+        block = distance_graph[np.ix_(members, members)].toarray()
+        scores.append(evaluate_clusters(block, labels[members], ch_db="medoid"))
+        weights.append(len(members))
+    return {name: round(float(np.average([score[name] for score in scores], weights=weights)), 3)
+            for name in scores[0]} if scores else {}
+
+
+def run_size(num_packages, num_clusters, base_url, args):
+    packages = create_dummy_packages(num_packages)
+    client = TomTomClient("mock", base_url=base_url, poll_interval=0.05, pool_size=args.max_concurrent_jobs)
+    model = KMedoidsClusteringModel(n_clusters=num_clusters, n_restarts=1)
+    cluster_manager = ClusterManager(packages, num_of_clusters=num_clusters, warehouse="W1", clustering_model=model,
+                                     tomtom_client=client, max_concurrent_jobs=args.max_concurrent_jobs,
+                                     retry_backoff=0.05)
+    metrics.reset()
+    seconds = {}
+    if num_packages <= args.dense_limit:
+        start = time.perf_counter()
+        cluster_manager.build_distance_matrix()
+        seconds["build_distance_matrix"] = time.perf_counter() - start
+        start = time.perf_counter()
+        cluster_manager.build_clusters()
+        seconds["build_clusters"] = time.perf_counter() - start
+    else:
+        # the partitioned build fetches and clusters in one call, the fetch span is the wall-clock time of its
+        # matrix jobs (partitions and boundary repair)
+        start = time.perf_counter()
+        cluster_manager.build_partitioned_clusters(max_partition_size=args.max_partition_size)
+        total = time.perf_counter() - start
+        seconds["build_distance_matrix"] = metrics.snapshot()["stages"]["fetch"]["seconds"]
+        seconds["build_clusters"] = total - seconds["build_distance_matrix"]
+
+    labels = cluster_manager.store.cluster[cluster_manager.rows]
+    start = time.perf_counter()
+    if num_packages <= args.dense_limit:
+        scores = evaluate_clusters(cluster_manager.distance_matrix, labels, ch_db="medoid")
+    else:
+        scores = evaluate_partitioned(cluster_manager.distance_matrix, labels, cluster_manager.partitions)
+    seconds["evaluate"] = time.perf_counter() - start
+
+    snapshot = metrics.snapshot()
+    return {
+        "mode": "dense" if num_packages <= args.dense_limit else "partitioned",
+        "seconds": {stage: round(value, 3) for stage, value in seconds.items()},
+        "counters": snapshot["counters"],
+        "peak_rss_bytes": snapshot["peak_rss_bytes"],
+        "scores": scores,
+    }
+
+
+def find_regressions(results, baseline, tolerance, noise_floor):
+    # (size, stage, expected seconds, seconds) of every stage slower than expected * (1 + tolerance), where the
+    # expected time is the baseline scaled by the calibration of this machine against the baseline's
+    regressions = []
+    for size, result in results.items():
+        previous = baseline.get(size)
+        if previous is None or previous["mode"] != result["mode"]:
+            continue
+        speed = result["calibration_seconds"] / previous["calibration_seconds"]
+        for stage in STAGES:
+            before, after = previous["seconds"][stage] * speed, result["seconds"][stage]
+            if after > before * (1 + tolerance) and after - before > noise_floor:
+                regressions.append((size, stage, before, after))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the clustering pipeline at 100, 1k and 10k packages")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--packages_per_cluster", type=int, default=50)
+    parser.add_argument("--dense_limit", type=int, default=2000,
+                        help="Largest package count whose full distance matrix is fetched")
+    parser.add_argument("--max_partition_size", type=int, default=500)
+    parser.add_argument("--max_concurrent_jobs", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds until a mock job completes")
+    parser.add_argument("--failure_rate", type=float, default=0.01, help="Share of mock jobs that fail")
+    parser.add_argument("--rate_limit", type=float, default=None, help="Mock submissions per second")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save_baseline", action="store_true", help="Store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown against the baseline")
+    parser.add_argument("--noise_floor", type=float, default=0.1, help="Slowdowns below this many seconds pass")
+    parser.add_argument("--output", default=None, help="Path of a JSON file for the results")
+    args = parser.parse_args()
+
+    process, port = start_mock_server({"latency": args.latency, "failure_rate": args.failure_rate,
+                                       "rate_limit": args.rate_limit})
+    base_url = f"http://127.0.0.1:{port}/routing/matrix/2/async"
+    results = {}
+    calibration_seconds = calibrate()
+    print(f"Calibration workload: {calibration_seconds:.3f} s")
+    try:
+        for num_packages in args.sizes:
+            num_clusters = max(2, num_packages // args.packages_per_cluster)
+            results[str(num_packages)] = result = run_size(num_packages, num_clusters, base_url, args)
+            result["calibration_seconds"] = round(calibration_seconds, 4)
+            print(f"{num_packages} packages ({result['mode']}, {num_clusters} clusters): "
+                  + ", ".join(f"{stage} {result['seconds'][stage]:.2f} s" for stage in STAGES)
+                  + f", {result['counters'].get('api_jobs', 0)} jobs, {result['counters'].get('retries', 0)} retries, "
+                    f"peak RSS {result['peak_rss_bytes'] / 2 ** 20:.0f} MiB, scores {result['scores']}")
+    finally:
+        process.terminate()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance, args.noise_floor)
+        for size, stage, before, after in regressions:
+            print(f"REGRESSION {size} packages, {stage}: {before:.2f} s expected on this machine, {after:.2f} s")
+        if regressions:
+            raise SystemExit(1)
+        print("No regressions against the baseline")
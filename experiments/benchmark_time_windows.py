@@ -0,0 +1,82 @@
+import argparse
+import time
+
+import numpy as np
+
+from experiments.benchmark_suite import start_mock_server
+from experiments.test_app import create_dummy_packages
+from models.kmedoids_clustering import KMedoidsClusteringModel
+from services.cluster_manager import ClusterManager
+from services.tomtom_client import TomTomClient
+from utils.instrumentation import metrics
+from utils.time_windows import compatible_windows, window_intervals
+
+# delivery shifts of the windowed workload, every package gets one of them
+SHIFTS = [("08:00", "10:00"), ("11:30", "13:30"), ("15:00", "17:00"), ("18:30", "20:30")]
+
+
+# The full distance matrix against build_windowed_distance_matrix on packages with delivery windows, on the mock
+# TomTom server: matrix cells requested, fetch and fit time, and whether any cluster mixes windows that no route
+# can serve together
+def create_windowed_packages(num_packages, no_window_share, seed=42):
+    packages = create_dummy_packages(num_packages, seed=seed)
+    random_state = np.random.RandomState(seed)
+    for package in packages:
+        if random_state.uniform() >= no_window_share:
+            package.opening_hour, package.closing_hour = SHIFTS[random_state.randint(len(SHIFTS))]
+    return packages
+
+
+def incompatible_clusters(cluster_manager, max_gap):
+    starts, ends = window_intervals(cluster_manager.store.opening_minutes[cluster_manager.rows],
+                                    cluster_manager.store.closing_minutes[cluster_manager.rows])
+    labels = cluster_manager.store.cluster[cluster_manager.rows]
+    mixed = 0
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        mixed += not compatible_windows(starts[members], ends[members], starts[members], ends[members], max_gap).all()
+    return mixed
+
+
+def run(packages, num_clusters, base_url, windowed, args):
+    client = TomTomClient("mock", base_url=base_url, poll_interval=0.05, pool_size=args.max_concurrent_jobs)
+    model = KMedoidsClusteringModel(n_clusters=num_clusters, n_restarts=1)
+    cluster_manager = ClusterManager(packages, num_of_clusters=num_clusters, warehouse="W1", clustering_model=model,
+                                     tomtom_client=client, max_concurrent_jobs=args.max_concurrent_jobs)
+    metrics.reset()
+    start = time.perf_counter()
+    if windowed:
+        cluster_manager.build_windowed_distance_matrix(max_gap=args.max_gap)
+    else:
+        cluster_manager.build_distance_matrix()
+    fetch_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    cluster_manager.build_clusters()
+    fit_seconds = time.perf_counter() - start
+    counters = metrics.snapshot()["counters"]
+    return (f"{counters.get('cells', 0)} cells in {counters.get('api_jobs', 0) + counters.get('sync_requests', 0)} "
+            f"requests, fetch {fetch_seconds:.2f} s, build_clusters {fit_seconds:.2f} s, "
+            f"{incompatible_clusters(cluster_manager, args.max_gap)} of {num_clusters} clusters mix incompatible windows")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark time-window pair pruning of the distance matrix")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[500, 2000])
+    parser.add_argument("--packages_per_cluster", type=int, default=50)
+    parser.add_argument("--max_gap", type=float, default=60, help="Minutes between windows one route can bridge")
+    parser.add_argument("--no_window_share", type=float, default=0.0, help="Share of packages without a window")
+    parser.add_argument("--max_concurrent_jobs", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds until a mock job completes")
+    args = parser.parse_args()
+
+    process, port = start_mock_server({"latency": args.latency})
+    base_url = f"http://127.0.0.1:{port}/routing/matrix/2/async"
+    try:
+        for num_packages in args.sizes:
+            packages = create_windowed_packages(num_packages, args.no_window_share)
+            num_clusters = max(2, num_packages // args.packages_per_cluster)
+            for windowed in [False, True]:
+                print(f"{num_packages} packages, {'windowed' if windowed else 'full'} matrix: "
+                      f"{run(packages, num_clusters, base_url, windowed, args)}")
+    finally:
+        process.terminate()
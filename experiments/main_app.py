@@ -1,19 +1,18 @@
 import argparse
-import csv
+import logging
 import numpy as np
 import matplotlib.pyplot as plt
 import folium
 
 from matplotlib.patches import Circle
 
-from sklearn.manifold import MDS
-from sklearn.metrics import silhouette_score, calinski_harabasz_score, davies_bouldin_score
-
-from data_models.package import Package
 from services.cluster_manager import ClusterManager
 from models.agglomerative_clustering import AgglomerativeClusteringModel
 from models.kmeans_clustering import KMeansClusteringModel
 from services.tomtom_client import TomTomClient
+from utils.evaluation_utils import evaluate_clusters
+from utils.instrumentation import metrics
+from utils.package_loader import load_packages
 
 # Precomputed distance matrix used for testing due to the API key limitations
 distance_matrix_50_packages = [
@@ -177,56 +176,8 @@ priority_sizes = {1: 200, 2: 500, 3: 800}
 priority_radius = {1: 6, 2: 9, 3: 15}
 
 def read_packages_from_csv(csv_file, max_packages=None):
-    packages = []
-    with open(csv_file, newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for i, row in enumerate(reader):
-            if max_packages and i >= max_packages:
-                break
-            packages.append(Package(package_id=row['id'], latitude=float(row['lat']), longitude=float(row['lon']),
-                                    opening_hour=row['opening_hour'], closing_hour=row['closing_hour'],
-                                    priority=int(row['priority']), cluster=int(row['cluster'])))
-    return packages
-
-def evaluate_clusters(distance_matrix, labels):
-    distance_matrix = np.array(distance_matrix)
-    sym_matrix = (distance_matrix + distance_matrix.T) / 2  # ensure symmetry
-
-    # Silhouette can take a precomputed distance matrix
-    silhouette = silhouette_score(sym_matrix, labels, metric="precomputed")
-
-    # CH and DB need features, so we can still use MDS if needed
-    mds = MDS(n_components=2, dissimilarity="precomputed", random_state=42)
-    features = mds.fit_transform(sym_matrix)
-    ch_score = calinski_harabasz_score(features, labels)
-    db_score = davies_bouldin_score(features, labels)
-
-    # Load balance: how similar cluster sizes are
-    unique_labels, counts = np.unique(labels, return_counts=True)
-    load_std = np.std(counts)  # smaller = more balanced
-    load_mean = np.mean(counts)
-    load_balance = 1 - (load_std / load_mean) if load_mean > 0 else 0  # normalized 0-1
-
-    # Sum of distances within clusters
-    sum_intra_cluster_distances = 0.0
-    for label in unique_labels:
-        idx = np.where(labels == label)[0]  # preserves the order of package indices
-        route_len = 0.0
-        if len(idx) > 1:
-            # sum distances between consecutive visits in the order of idx
-            for i in range(len(idx) - 1):
-                a = idx[i]
-                b = idx[i + 1]
-                route_len += float(sym_matrix[a, b])
-        sum_intra_cluster_distances += route_len
-
-    return {
-        "silhouette": round(silhouette,3),
-        "calinski_harabasz": round(ch_score, 3),
-        "davies_bouldin": round(db_score, 3),
-        "load_balance": round(float(load_balance), 3),
-        "sum_intra_cluster_distances": round(float(sum_intra_cluster_distances) / 1000.0, 3)
-    }
+    packages = load_packages(csv_file)
+    return packages[:max_packages] if max_packages else packages
 
 def plot_clusters(packages, labels, title="Clusters"):
     lats = [p.latitude for p in packages]
@@ -280,6 +231,7 @@ def plot_clusters(packages, labels, title="Clusters"):
     plt.grid(True, alpha=0.3)
     plt.show()
 
+@metrics.span("render")
 def visualise_on_map(packages, num_clusters, num_packages, algorithm, w_d, w_p):
     cluster_colors = {
         0: "red",
@@ -337,7 +289,7 @@ def main(num_clusters=2, num_packages=10, distance_weight=0.5, distance_priority
 
     # KMeans
     labels_km = [p.get_cluster() for p in cluster_manager_km.packages]
-    scores_km = evaluate_clusters(cluster_manager_km.distance_matrix, labels_km)
+    scores_km = evaluate_clusters(cluster_manager_km.distance_matrix, labels_km, ch_db="embedding")
     print("\n=== KMeans Metrics ===")
     print(scores_km)
     # plot_clusters(packages, labels_km, f"K-Means: {num_clusters} clusters, {num_packages} packages")
@@ -361,7 +313,7 @@ def main(num_clusters=2, num_packages=10, distance_weight=0.5, distance_priority
         print(cluster)
 
     labels_agg = [p.get_cluster() for p in cluster_manager_agg.packages]
-    scores_agg = evaluate_clusters(cluster_manager_agg.distance_matrix, labels_agg)
+    scores_agg = evaluate_clusters(cluster_manager_agg.distance_matrix, labels_agg, ch_db="embedding")
     print("\n=== Agglomerative Metrics ===")
     print(scores_agg)
     #plot_clusters(packages, labels_agg, f"Agglomerative Clustering, {num_clusters} clusters, {num_packages} packages")
@@ -369,33 +321,16 @@ def main(num_clusters=2, num_packages=10, distance_weight=0.5, distance_priority
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Run clustering script with API key")
-    parser.add_argument("--api_key", required=True, help="API key for TomTom API or other services")
+    # the sweep works on the precomputed distance matrix, it needs no API key and no distance cache
+    parser = argparse.ArgumentParser(description="Run the clustering sweep on the precomputed distance matrix")
+    parser.add_argument("--log_level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--metrics", default=None,
+                        help="Path of a file for the stage timings and counters (.prom for Prometheus text, else JSON)")
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 
-    api_key = args.api_key
-
-    print("=== 2 Clusters 10 Packages ===")
-    main(num_clusters=2, num_packages=10, distance_weight=0.5, distance_priority=0.5, api_key=api_key)
-    main(num_clusters=2, num_packages=10, distance_weight=0.2, distance_priority=0.8, api_key=api_key)
-    main(num_clusters=2, num_packages=10, distance_weight=0.8, distance_priority=0.2, api_key=api_key)
-    print("\n\n=== 3 Clusters 10 Packages ===")
-    main(num_clusters=3, num_packages=10, distance_weight=0.5, distance_priority=0.5, api_key=api_key)
-    main(num_clusters=3, num_packages=10, distance_weight=0.2, distance_priority=0.8, api_key=api_key)
-    main(num_clusters=3, num_packages=10, distance_weight=0.8, distance_priority=0.2, api_key=api_key)
-    print("\n\n=== 4 Clusters 30 Packages ===")
-    main(num_clusters=4, num_packages=30, distance_weight=0.5, distance_priority=0.5, api_key=api_key)
-    main(num_clusters=4, num_packages=30, distance_weight=0.2, distance_priority=0.8, api_key=api_key)
-    main(num_clusters=4, num_packages=30, distance_weight=0.8, distance_priority=0.2, api_key=api_key)
-    print("\n\n=== 6 Clusters 10 Packages ===")
-    main(num_clusters=6, num_packages=30, distance_weight=0.5, distance_priority=0.5, api_key=api_key)
-    main(num_clusters=6, num_packages=30, distance_weight=0.2, distance_priority=0.8, api_key=api_key)
-    main(num_clusters=6, num_packages=30, distance_weight=0.8, distance_priority=0.2, api_key=api_key)
-    print("\n\n=== 5 Clusters 50 Packages ===")
-    main(num_clusters=5, num_packages=50, distance_weight=0.5, distance_priority=0.5, api_key=api_key)
-    main(num_clusters=5, num_packages=50, distance_weight=0.2, distance_priority=0.8, api_key=api_key)
-    main(num_clusters=5, num_packages=50, distance_weight=0.8, distance_priority=0.2, api_key=api_key)
-    print("\n\n=== 8 Clusters 50 Packages ===")
-    main(num_clusters=8, num_packages=50, distance_weight=0.5, distance_priority=0.5, api_key=api_key)
-    main(num_clusters=8, num_packages=50, distance_weight=0.2, distance_priority=0.8, api_key=api_key)
-    main(num_clusters=8, num_packages=50, distance_weight=0.8, distance_priority=0.2, api_key=api_key)
\ No newline at end of file
+    # all the thesis runs (2-8 clusters, 10-50 packages, three weightings, both algorithms) as one sweep
+    from experiments.sweep import run_sweep, format_table
+    print(format_table(run_sweep(render_maps=True)))
+    if args.metrics:
+        metrics.write(args.metrics)
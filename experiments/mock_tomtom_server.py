@@ -0,0 +1,226 @@
+import argparse
+import gzip
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import numpy as np
+
+from services.rate_limiter import TokenBucket
+from utils.distances_utils import haversine_distances
+
+MATRIX_ROUTING_PATH = "/routing/matrix/2/async"
+SYNC_MATRIX_ROUTING_PATH = "/routing/matrix/2"
+
+
+# Local stand-in for the TomTom Matrix Routing v2 API, async (submit, status, download) and sync, used to exercise
+# the fetch path without an API key. Road distances are synthesised from the coordinates.
+class MockTomTomServer:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, detour_factor=1.3, average_speed=8.3,
+                 max_cells=2500, sync_max_cells=200, sync_latency=0.0, failure_rate=0.0, rate_limit=None,
+                 burst=10, seed=0):
+        self.host = host
+        self.port = port
+        # seconds until a submitted job is reported as Completed
+        self.latency = latency
+        # share of async jobs that end in the Failed state instead
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        # submissions per second (bursts of up to `burst`), more are answered with 429 and a Retry-After header
+        self.rate_limiter = TokenBucket(rate_limit, burst) if rate_limit else None
+        # matrices above these cell counts are rejected with 400, like the real limits
+        self.max_cells = max_cells
+        self.sync_max_cells = sync_max_cells
+        # seconds a synchronous request takes to answer
+        self.sync_latency = sync_latency
+        self.detour_factor = detour_factor
+        # metres per second, used to derive travel times
+        self.average_speed = average_speed
+        self.jobs = {}
+        self.submitted_jobs = 0
+        self.failed_jobs = 0
+        self.rate_limited_requests = 0
+        self.sync_requests = 0
+        self.status_requests = 0
+        # TCP connections accepted, fewer than requests when clients keep connections alive
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}{MATRIX_ROUTING_PATH}"
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer((self.host, self.port), _MockTomTomRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def submit_job(self, request_body):
+        job_id = str(uuid.uuid4())
+        with self.lock:
+            failed = self.random.random() < self.failure_rate
+            self.jobs[job_id] = {"body": request_body, "ready_at": time.monotonic() + self.latency, "failed": failed}
+            self.submitted_jobs += 1
+            self.failed_jobs += failed
+        return job_id
+
+    def retry_after(self):
+        # None when a submission may pass the rate limit, else the whole seconds to wait
+        if self.rate_limiter is None or self.rate_limiter.try_acquire():
+            return None
+        with self.lock:
+            self.rate_limited_requests += 1
+        return max(1, math.ceil(1 / self.rate_limiter.rate))
+
+    def get_job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def compute_result(self, request_body):
+        origins = [o["point"] for o in request_body["origins"]]
+        destinations = [d["point"] for d in request_body["destinations"]]
+        origin_lats = np.array([o["latitude"] for o in origins])
+        origin_lons = np.array([o["longitude"] for o in origins])
+        destination_lats = np.array([d["latitude"] for d in destinations])
+        destination_lons = np.array([d["longitude"] for d in destinations])
+
+        distances = haversine_distances(origin_lats, origin_lons, destination_lats, destination_lons)
+        # one-way streets and turn restrictions make road distances direction dependent
+        asymmetry = 1 + 0.1 * np.abs(np.sin(origin_lats[:, None] * 1e3 + destination_lons[None, :] * 1e3))
+        lengths = np.rint(distances * self.detour_factor * asymmetry).astype(int)
+        travel_times = np.rint(lengths / self.average_speed).astype(int)
+        traffic_delays = np.rint(travel_times * 0.1 * asymmetry).astype(int)
+
+        # the JSON is formatted directly, building and serialising one dict per cell would make the mock slower
+        # than the client it exercises
+        cells = ",".join(
+            f'{{"originIndex":{oi},"destinationIndex":{dj},"routeSummary":{{"lengthInMeters":{length},'
+            f'"travelTimeInSeconds":{travel_time},"trafficDelayInSeconds":{traffic_delay}}}}}'
+            for oi, (length_row, time_row, delay_row) in enumerate(zip(lengths.tolist(), travel_times.tolist(),
+                                                                       traffic_delays.tolist()))
+            for dj, (length, travel_time, traffic_delay) in enumerate(zip(length_row, time_row, delay_row)))
+        count = lengths.size
+        return (f'{{"data":[{cells}],"statistics":{{"totalCount":{count},"successes":{count},"failures":0}}}}'
+                .encode("utf-8"))
+
+
+class _MockTomTomRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive connections, like the real API; headers and body are separate writes, so without TCP_NODELAY
+    # every answer on a kept-alive connection would wait for a delayed ACK
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.mock.lock:
+            self.server.mock.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        # payload: a JSON-serialisable object or an already encoded JSON body
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if "gzip" in self.headers.get("Accept-Encoding", "") and len(body) > 1024:
+            body = gzip.compress(body, compresslevel=1)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        # the body is read before any answer, so a kept-alive connection stays in step
+        length = int(self.headers.get("Content-Length", 0))
+        raw_body = self.rfile.read(length)
+        path = urlparse(self.path).path
+        if path not in (MATRIX_ROUTING_PATH, SYNC_MATRIX_ROUTING_PATH):
+            self._send_json(404, {"detailedError": {"message": f"Unknown path {path}"}})
+            return
+
+        mock = self.server.mock
+        retry_after = mock.retry_after()
+        if retry_after is not None:
+            self._send_json(429, {"detailedError": {"message": "Too many requests"}},
+                            headers={"Retry-After": str(retry_after)})
+            return
+        request_body = json.loads(raw_body)
+        cells = len(request_body["origins"]) * len(request_body["destinations"])
+        max_cells = mock.max_cells if path == MATRIX_ROUTING_PATH else mock.sync_max_cells
+        if cells > max_cells:
+            self._send_json(400, {"detailedError": {"message": f"Matrix of {cells} cells exceeds {max_cells}"}})
+            return
+
+        if path == SYNC_MATRIX_ROUTING_PATH:
+            with mock.lock:
+                mock.sync_requests += 1
+            time.sleep(mock.sync_latency)
+            self._send_json(200, mock.compute_result(request_body))
+            return
+        job_id = mock.submit_job(request_body)
+        self._send_json(202, {"jobId": job_id, "state": "Submitted"})
+
+    def do_GET(self):
+        parts = urlparse(self.path).path[len(MATRIX_ROUTING_PATH):].strip("/").split("/")
+        job = self.server.mock.get_job(parts[0])
+        if job is None:
+            self._send_json(404, {"detailedError": {"message": f"Unknown job {parts[0]}"}})
+            return
+
+        completed = time.monotonic() >= job["ready_at"]
+        if len(parts) == 1:
+            with self.server.mock.lock:
+                self.server.mock.status_requests += 1
+            state = ("Failed" if job["failed"] else "Completed") if completed else "InProgress"
+            self._send_json(200, {"jobId": parts[0], "state": state})
+        elif parts[1] == "result" and completed and not job["failed"]:
+            self._send_json(200, self.server.mock.compute_result(job["body"]))
+        else:
+            self._send_json(404, {"detailedError": {"message": "Result is not available"}})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local mock of the TomTom Matrix Routing API")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=1.0, help="Seconds until a submitted job completes")
+    parser.add_argument("--sync_latency", type=float, default=0.1, help="Seconds a synchronous request takes")
+    parser.add_argument("--max_cells", type=int, default=2500, help="Cell limit of an async job")
+    parser.add_argument("--sync_max_cells", type=int, default=200, help="Cell limit of a synchronous request")
+    parser.add_argument("--failure_rate", type=float, default=0.0, help="Share of async jobs that fail")
+    parser.add_argument("--rate_limit", type=float, default=None, help="Submissions per second before 429 answers")
+    args = parser.parse_args()
+
+    server = MockTomTomServer(port=args.port, latency=args.latency, max_cells=args.max_cells,
+                              sync_max_cells=args.sync_max_cells, sync_latency=args.sync_latency,
+                              failure_rate=args.failure_rate, rate_limit=args.rate_limit).start()
+    print(f"Mock TomTom server listening on {server.base_url}")
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
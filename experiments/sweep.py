@@ -0,0 +1,137 @@
+import argparse
+import csv
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from experiments.main_app import (CSV_FILE_PATH, distance_matrix_50_packages, read_packages_from_csv,
+                                  visualise_on_map)
+from models.agglomerative_clustering import AgglomerativeClusteringModel
+from models.kmeans_clustering import KMeansClusteringModel
+from models.kmedoids_clustering import KMedoidsClusteringModel
+from utils.distances_utils import normalize_matrix, get_priority_diversity_matrix
+from utils.evaluation_utils import evaluate_clusters
+from utils.instrumentation import metrics as registry
+
+ALGORITHMS = ["KMeans", "Agglomerative"]
+
+# (n_clusters, n_packages, distance_weight, priority_weight, algorithm), the runs of the thesis experiments
+DEFAULT_GRID = [
+    (n_clusters, n_packages, w_d, w_p, algorithm)
+    for n_clusters, n_packages in [(2, 10), (3, 10), (4, 30), (6, 30), (5, 50), (8, 50)]
+    for w_d, w_p in [(0.5, 0.5), (0.2, 0.8), (0.8, 0.2)]
+    for algorithm in ALGORITHMS
+]
+
+METRIC_COLUMNS = ["silhouette", "calinski_harabasz", "davies_bouldin", "load_balance", "sum_intra_cluster_distances"]
+
+
+def fit_labels(algorithm, similarity, cluster_counts):
+    if algorithm == "KMeans":
+        return {n_clusters: KMeansClusteringModel(n_clusters=n_clusters).fit(similarity) for n_clusters in cluster_counts}
+    if algorithm == "Agglomerative":
+        # one merge tree, cut at every cluster count
+        return AgglomerativeClusteringModel(n_clusters=cluster_counts[0]).fit_range(similarity, cluster_counts)
+    if algorithm == "KMedoids":
+        return {n_clusters: KMedoidsClusteringModel(n_clusters=n_clusters).fit(similarity) for n_clusters in cluster_counts}
+    raise ValueError(f"Unknown algorithm: {algorithm}")
+
+
+def run_group(packages, distance_matrix, normalized_distances, priority_matrix, distance_weight, priority_weight,
+              algorithm, cluster_counts, render_maps=False):
+    # every cluster count of one (n_packages, weights, algorithm) group shares the same similarity matrix
+    with registry.span("normalize"):
+        similarity = (distance_weight * normalized_distances) + (priority_weight * priority_matrix)
+    with registry.span("fit"):
+        fits = fit_labels(algorithm, similarity, cluster_counts)
+
+    rows = []
+    for n_clusters, labels in fits.items():
+        # CH/DB on the MDS embedding of the distance matrix, computed once per process and package count
+        metrics = evaluate_clusters(distance_matrix, labels, ch_db="embedding")
+        if render_maps:
+            for package, label in zip(packages, labels):
+                package.set_cluster(label)
+            visualise_on_map(packages, n_clusters, len(packages), algorithm, distance_weight, priority_weight)
+        rows.append({
+            "n_clusters": n_clusters,
+            "n_packages": len(packages),
+            "distance_weight": distance_weight,
+            "priority_weight": priority_weight,
+            "algorithm": algorithm,
+            **metrics,
+        })
+    return rows
+
+
+def run_group_with_metrics(*args):
+    # worker processes keep their own registry, its snapshot is returned with the rows and merged by the parent
+    registry.reset()
+    return run_group(*args), registry.snapshot()
+
+
+def run_sweep(grid=DEFAULT_GRID, max_workers=None, render_maps=False, csv_file=CSV_FILE_PATH,
+              distance_matrix=distance_matrix_50_packages):
+    all_packages = read_packages_from_csv(csv_file, max_packages=max(n_packages for _, n_packages, _, _, _ in grid))
+    distance_matrix = np.asarray(distance_matrix)
+
+    groups = {}
+    for n_clusters, n_packages, w_d, w_p, algorithm in grid:
+        groups.setdefault((n_packages, w_d, w_p, algorithm), []).append(n_clusters)
+
+    # intermediates that only depend on the package subset are computed once
+    intermediates = {}
+    for n_packages in sorted({n_packages for n_packages, _, _, _ in groups}):
+        submatrix = distance_matrix[:n_packages, :n_packages]
+        priorities = [p.get_priority() for p in all_packages[:n_packages]]
+        intermediates[n_packages] = (submatrix, normalize_matrix(submatrix), get_priority_diversity_matrix(priorities))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(run_group_with_metrics, all_packages[:n_packages], *intermediates[n_packages], w_d, w_p, algorithm,
+                            sorted(cluster_counts), render_maps)
+            for (n_packages, w_d, w_p, algorithm), cluster_counts in groups.items()
+        ]
+        rows = []
+        for future in futures:
+            group_rows, snapshot = future.result()
+            rows += group_rows
+            registry.merge(snapshot)
+
+    return sorted(rows, key=lambda r: (r["n_packages"], r["n_clusters"], -r["distance_weight"], r["algorithm"]))
+
+
+def format_table(rows):
+    columns = ["n_clusters", "n_packages", "distance_weight", "priority_weight", "algorithm"] + METRIC_COLUMNS
+    widths = [max(len(column), *(len(str(row[column])) for row in rows)) for column in columns]
+    lines = ["  ".join(column.ljust(width) for column, width in zip(columns, widths))]
+    for row in rows:
+        lines.append("  ".join(str(row[column]).ljust(width) for column, width in zip(columns, widths)))
+    return "\n".join(lines)
+
+
+def write_csv(rows, path):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the clustering parameter sweep and print one metrics table")
+    parser.add_argument("--max_workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--render_maps", action="store_true", help="Save a map of every clustering")
+    parser.add_argument("--output", default=None, help="Path of a CSV file for the metrics table")
+    parser.add_argument("--metrics", default=None,
+                        help="Path of a file for the stage timings and counters (.prom for Prometheus text, else JSON)")
+    parser.add_argument("--log_level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    results = run_sweep(max_workers=args.max_workers, render_maps=args.render_maps)
+    print(format_table(results))
+    if args.output:
+        write_csv(results, args.output)
+    if args.metrics:
+        registry.write(args.metrics)
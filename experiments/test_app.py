@@ -1,14 +1,12 @@
 import numpy as np
 from scipy.spatial import distance_matrix
 
-from sklearn.manifold import MDS
-from sklearn.metrics import silhouette_score, calinski_harabasz_score, davies_bouldin_score
-
 from data_models.package import Package
 from services.cluster_manager import ClusterManager
 from models.agglomerative_clustering import AgglomerativeClusteringModel
 from models.kmeans_clustering import KMeansClusteringModel
 from services.tomtom_client import TomTomClient
+from utils.evaluation_utils import evaluate_clusters
 
 
 API_KEY = ".."
@@ -16,28 +14,8 @@ NUM_CLUSTERS = 3
 NUM_PACKAGES = 10
 
 
-def evaluate_clusters(distance_matrix, labels):
-    distance_matrix = np.array(distance_matrix)
-    sym_matrix = (distance_matrix + distance_matrix.T) / 2  # ensure symmetry
-
-    # Silhouette can take a precomputed distance matrix
-    silhouette = silhouette_score(sym_matrix, labels, metric="precomputed")
-
-    # CH and DB need features, so we can still use MDS if needed
-    mds = MDS(n_components=2, dissimilarity="precomputed", random_state=42)
-    features = mds.fit_transform(sym_matrix)
-    ch_score = calinski_harabasz_score(features, labels)
-    db_score = davies_bouldin_score(features, labels)
-
-    return {
-        "silhouette": silhouette,
-        "calinski_harabasz": ch_score,
-        "davies_bouldin": db_score
-    }
-
-
 # 🔹 Create dummy packages
-def create_dummy_packages(seed=42):
+def create_dummy_packages(num_packages=NUM_PACKAGES, seed=42):
     np.random.seed(seed)
 
     # Rough bounding box for Belgrade
@@ -45,7 +23,7 @@ def create_dummy_packages(seed=42):
     min_lon, max_lon = 20.38, 20.50
 
     packages = []
-    for i in range(NUM_PACKAGES):
+    for i in range(num_packages):
         lat = np.random.uniform(min_lat, max_lat)
         lon = np.random.uniform(min_lon, max_lon)
         priority = np.random.randint(1, 4)  # priority 1-3
@@ -96,7 +74,7 @@ def run_test():
         print(cluster)
 
     labels_agg = [p.get_cluster() for p in cluster_manager_agg.packages]
-    scores_agg = evaluate_clusters(cluster_manager_agg.distance_matrix, labels_agg)
+    scores_agg = evaluate_clusters(cluster_manager_agg.distance_matrix, labels_agg, ch_db="embedding")
     print("\n=== Agglomerative Metrics ===")
     print(scores_agg)
 
@@ -118,7 +96,7 @@ def run_test():
 
     # KMeans
     labels_km = [p.get_cluster() for p in cluster_manager_km.packages]
-    scores_km = evaluate_clusters(cluster_manager_km.distance_matrix, labels_km)
+    scores_km = evaluate_clusters(cluster_manager_km.distance_matrix, labels_km, ch_db="embedding")
     print("\n=== KMeans Metrics ===")
     print(scores_km)
 
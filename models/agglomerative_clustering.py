@@ -1,16 +1,88 @@
+from heapq import heappush, heappushpop
+
+import numpy as np
+from scipy import sparse
+from scipy.cluster import hierarchy
 from sklearn.cluster import AgglomerativeClustering
 from models.base_model import BaseClusteringModel
+from utils.distances_utils import matrix_fingerprint
 
 class AgglomerativeClusteringModel(BaseClusteringModel):
-    def __init__(self, n_clusters, linkage="complete"):
+    def __init__(self, n_clusters, linkage="complete", connectivity=None):
         self.n_clusters = n_clusters
         self.linkage = linkage
+        # optional sparse graph restricting merges to neighbouring packages
+        self.connectivity = connectivity
         self.model = None
+        # merge tree of the last fitted similarity matrix, every cluster count is a cut of the same tree
+        self.children_ = None
+        self._tree_key = None
 
     def fit(self, similarity_matrix):
-        self.model = AgglomerativeClustering(
-            metric="precomputed",
-            n_clusters=self.n_clusters,
-            linkage=self.linkage,
-        )
-        return self.model.fit(similarity_matrix).labels_
\ No newline at end of file
+        return self.fit_range(similarity_matrix, [self.n_clusters])[self.n_clusters]
+
+    def fit_range(self, similarity_matrix, cluster_counts):
+        children = self._get_tree(similarity_matrix)
+        num_packages = similarity_matrix.shape[0]
+        return {n_clusters: cut_tree(children, num_packages, n_clusters) for n_clusters in cluster_counts}
+
+    def _get_tree(self, similarity_matrix):
+        key = (matrix_fingerprint(similarity_matrix), self.linkage, id(self.connectivity))
+        if key == self._tree_key:
+            return self.children_
+
+        connectivity = self.connectivity
+        if sparse.issparse(similarity_matrix):
+            # only pairs stored in the graph may be merged directly, the others are treated as far apart
+            graph = similarity_matrix.tocsr()
+            stored = graph.astype(bool).astype(np.float64)
+            # average both directions where a pair is stored twice
+            graph = (graph + graph.T).multiply((stored + stored.T).power(-1)).tocoo()
+            if connectivity is None:
+                connectivity = graph
+            dense = np.full(graph.shape, graph.data.max() * 2 if graph.nnz else 1.0)
+            np.fill_diagonal(dense, 0)
+            dense[graph.row, graph.col] = graph.data
+            similarity_matrix = dense
+
+        if connectivity is None:
+            # the same tree sklearn builds for a precomputed matrix without connectivity
+            rows, cols = np.triu_indices(similarity_matrix.shape[0], k=1)
+            tree = hierarchy.linkage(np.asarray(similarity_matrix, dtype=np.float64)[rows, cols], method=self.linkage)
+            children = tree[:, :2].astype(int)
+        else:
+            self.model = AgglomerativeClustering(
+                metric="precomputed",
+                n_clusters=self.n_clusters,
+                linkage=self.linkage,
+                connectivity=connectivity,
+                compute_full_tree=True,
+            )
+            children = self.model.fit(similarity_matrix).children_
+
+        self.children_ = children
+        self._tree_key = key
+        return children
+
+
+def cut_tree(children, n_leaves, n_clusters):
+    # undoes the last n_clusters - 1 merges, labels are numbered like sklearn's AgglomerativeClustering
+    if not 1 <= n_clusters <= n_leaves:
+        raise ValueError(f"n_clusters must be between 1 and {n_leaves}, got {n_clusters}")
+
+    nodes = [-(max(children[-1]) + 1)] if len(children) else [0]
+    for _ in range(n_clusters - 1):
+        these_children = children[-nodes[0] - n_leaves]
+        heappush(nodes, -these_children[0])
+        heappushpop(nodes, -these_children[1])
+
+    labels = np.zeros(n_leaves, dtype=np.intp)
+    for label, node in enumerate(nodes):
+        stack = [-node]
+        while stack:
+            node = stack.pop()
+            if node < n_leaves:
+                labels[node] = label
+            else:
+                stack.extend(children[node - n_leaves])
+    return labels
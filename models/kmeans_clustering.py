@@ -1,28 +1,28 @@
-import numpy as np
 from sklearn.cluster import KMeans
-from sklearn.manifold import MDS
 from models.base_model import BaseClusteringModel
+from utils.embedding_utils import get_embedding
 
 class KMeansClusteringModel(BaseClusteringModel):
-    def __init__(self, n_clusters, n_components=2, random_state=42):
+    def __init__(self, n_clusters, n_components=2, random_state=42, embedding="smacof", n_landmarks=200):
         self.n_clusters = n_clusters
         self.n_components = n_components
         self.random_state = random_state
+        # "smacof" (sklearn MDS), "classical" (truncated eigendecomposition) or "landmark" (m landmarks, O(n*m))
+        self.embedding = embedding
+        self.n_landmarks = n_landmarks
         self.model = None
 
     def fit(self, similarity_matrix):
-        # Ensure matrix is symmetric
-        if not np.allclose(similarity_matrix, similarity_matrix.T):
-            similarity_matrix = (similarity_matrix + similarity_matrix.T) / 2
-
-        # Use MDS to project distances → feature space
-        mds = MDS(
+        # Use MDS to project distances → feature space, the projection is cached per matrix
+        # so fits with other cluster counts reuse it
+        features = get_embedding(
+            similarity_matrix,
+            method=self.embedding,
             n_components=self.n_components,
             random_state=self.random_state,
-            dissimilarity="precomputed"
+            n_landmarks=self.n_landmarks,
         )
-        features = mds.fit_transform(similarity_matrix)
 
         # Apply KMeans on feature space
         self.model = KMeans(n_clusters=self.n_clusters, random_state=self.random_state)
-        return self.model.fit(features).labels_
\ No newline at end of file
+        return self.model.fit(features).labels_
@@ -0,0 +1,129 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from models.base_model import BaseClusteringModel
+from utils.embedding_utils import symmetrize
+
+class KMedoidsClusteringModel(BaseClusteringModel):
+    def __init__(self, n_clusters, n_restarts=4, max_iter=100, random_state=42, n_jobs=1, block_size=256):
+        self.n_clusters = n_clusters
+        self.n_restarts = n_restarts
+        self.max_iter = max_iter
+        self.random_state = random_state
+        # restarts run in this many worker processes
+        self.n_jobs = n_jobs
+        # number of swap candidates evaluated together
+        self.block_size = block_size
+        self.medoid_indices_ = None
+        self.inertia_ = None
+
+    def fit(self, similarity_matrix):
+        matrix = np.array(symmetrize(similarity_matrix), dtype=np.float64)
+        # the priority term of the similarity is not zero on the diagonal, a medoid must be nearest to itself
+        np.fill_diagonal(matrix, 0)
+        if not 1 <= self.n_clusters < matrix.shape[0]:
+            raise ValueError(f"n_clusters must be between 1 and {matrix.shape[0] - 1}, got {self.n_clusters}")
+
+        seeds = [self.random_state + restart for restart in range(self.n_restarts)]
+        args = (self.n_clusters, self.max_iter, self.block_size)
+        if self.n_jobs == 1 or self.n_restarts == 1:
+            _init_worker(matrix)
+            results = [_run_restart(seed, *args) for seed in seeds]
+        else:
+            # the matrix reaches the workers once through the initializer instead of with every restart
+            with ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_init_worker, initargs=(matrix,)) as executor:
+                results = list(executor.map(_run_restart, seeds, *[[arg] * len(seeds) for arg in args]))
+
+        self.inertia_, self.medoid_indices_, labels = min(results, key=lambda result: result[0])
+        return labels
+
+
+_worker_matrix = None
+
+
+def _init_worker(matrix):
+    global _worker_matrix
+    _worker_matrix = matrix
+
+
+def _run_restart(seed, n_clusters, max_iter, block_size):
+    medoids = _init_medoids(_worker_matrix, n_clusters, np.random.RandomState(seed))
+    medoids = faster_pam(_worker_matrix, medoids, max_iter, block_size)
+    labels, nearest_distances, _, _ = _assign(_worker_matrix, medoids)
+    return float(nearest_distances.sum()), medoids, labels
+
+
+def _init_medoids(matrix, n_clusters, random_state):
+    # k-means++ style seeding on the precomputed distances
+    medoids = [random_state.randint(matrix.shape[0])]
+    nearest_distances = matrix[:, medoids[0]].copy()
+    for _ in range(1, n_clusters):
+        weights = nearest_distances ** 2
+        total = weights.sum()
+        candidate = random_state.choice(matrix.shape[0], p=weights / total) if total > 0 else \
+            random_state.choice(np.setdiff1d(np.arange(matrix.shape[0]), medoids))
+        medoids.append(candidate)
+        np.minimum(nearest_distances, matrix[:, candidate], out=nearest_distances)
+    return np.array(medoids)
+
+
+def _assign(matrix, medoids):
+    # index of the nearest medoid and distances to the nearest and the second nearest one, O(n*k)
+    distances = matrix[:, medoids]
+    if len(medoids) == 1:
+        return np.zeros(len(distances), dtype=np.intp), distances[:, 0], np.zeros(len(distances), dtype=np.intp), \
+            np.full(len(distances), np.inf)
+    order = np.argpartition(distances, 1, axis=1)[:, :2]
+    nearest, second = order[:, 0], order[:, 1]
+    rows = np.arange(len(distances))
+    return nearest, distances[rows, nearest], second, distances[rows, second]
+
+
+def faster_pam(matrix, medoids, max_iter=100, block_size=256, tolerance=1e-12):
+    # FasterPAM swap search (Schubert & Rousseeuw): the change of the total deviation for swapping a candidate with
+    # every medoid is accumulated in one O(n + k) pass per candidate, here for a block of candidates at once. The
+    # points are kept sorted by their nearest medoid, so the terms of one medoid are a contiguous run summed by
+    # reduceat; the matrix is symmetric, the distances of a candidate are read from its row
+    num_points = matrix.shape[0]
+    n_clusters = len(medoids)
+    if n_clusters == 1:
+        return np.array([np.argmin(matrix.sum(axis=0))])
+
+    def bookkeeping(medoids):
+        nearest, nearest_distances, _, second_distances = _assign(matrix, medoids)
+        order = np.argsort(nearest, kind="stable")
+        counts = np.bincount(nearest, minlength=n_clusters)
+        occupied = counts > 0
+        run_starts = (np.cumsum(counts) - counts)[occupied]
+        # increase of the total deviation when a medoid is removed and its points move to their second medoid
+        removal_loss = np.bincount(nearest, weights=second_distances - nearest_distances, minlength=n_clusters)
+        return order, nearest_distances[order], second_distances[order], occupied, run_starts, removal_loss
+
+    medoids = np.array(medoids)
+    order, nearest_distances, second_distances, occupied, run_starts, removal_loss = bookkeeping(medoids)
+    for _ in range(max_iter):
+        swapped = False
+        for start in range(0, num_points, block_size):
+            candidates = np.arange(start, min(start + block_size, num_points))
+            candidate_distances = matrix[candidates][:, order]
+            gain = candidate_distances - nearest_distances
+            closer = gain < 0
+            shared = np.where(closer, gain, 0).sum(axis=1)
+            # points closer to the candidate move there, so removing their medoid costs nothing for them
+            per_point = np.where(closer, nearest_distances - second_distances, 0)
+            # points between their nearest and second medoid move to the candidate if their medoid is removed
+            between = ~closer & (candidate_distances < second_distances)
+            per_point += np.where(between, candidate_distances - second_distances, 0)
+            per_medoid = np.zeros((len(candidates), n_clusters))
+            per_medoid[:, occupied] = np.add.reduceat(per_point, run_starts, axis=1)
+            delta = removal_loss[None, :] + shared[:, None] + per_medoid
+            delta[np.isin(candidates, medoids)] = np.inf
+
+            candidate, medoid = np.unravel_index(np.argmin(delta), delta.shape)
+            if delta[candidate, medoid] < -tolerance:
+                medoids[medoid] = candidates[candidate]
+                order, nearest_distances, second_distances, occupied, run_starts, removal_loss = bookkeeping(medoids)
+                swapped = True
+        if not swapped:
+            break
+    return medoids
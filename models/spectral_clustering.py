@@ -0,0 +1,29 @@
+import numpy as np
+from scipy import sparse
+from sklearn.cluster import SpectralClustering
+from models.base_model import BaseClusteringModel
+
+class SpectralClusteringModel(BaseClusteringModel):
+    def __init__(self, n_clusters, random_state=42):
+        self.n_clusters = n_clusters
+        self.random_state = random_state
+        self.model = None
+
+    def fit(self, similarity_matrix):
+        # works on dense matrices and on the sparse k-nearest-neighbour graphs of ClusterManager,
+        # for a graph only its O(n*k) stored entries are ever touched
+        if sparse.issparse(similarity_matrix):
+            affinity = similarity_matrix.tocsr(copy=True).astype(np.float64)
+            affinity.data = np.exp(-(affinity.data / np.median(affinity.data)) ** 2)
+            affinity = affinity.maximum(affinity.T)
+        else:
+            similarity_matrix = np.asarray(similarity_matrix, dtype=np.float64)
+            affinity = np.exp(-(similarity_matrix / np.median(similarity_matrix)) ** 2)
+            affinity = (affinity + affinity.T) / 2
+
+        self.model = SpectralClustering(
+            n_clusters=self.n_clusters,
+            affinity="precomputed",
+            random_state=self.random_state,
+        )
+        return self.model.fit(affinity).labels_
@@ -1,61 +1,857 @@
+import copy
+import logging
+import random
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
 import numpy as np
+import requests
+from scipy import sparse
 
 from data_models.cluster import Cluster
 from data_models.package import Package
-from services.tomtom_client import TomTomClient
-from utils.distances_utils import normalize_matrix, get_priority_diversity_matrix
+from data_models.package_store import PackageStore
+from services.cluster_rebalancer import ClusterRebalancer
+from services.route_optimizer import solve_cluster_routes
+from services.tomtom_client import LENGTH, TomTomClient
+from utils.distances_utils import (blend_layers, k_nearest_neighbours, spatial_order, build_sparse_similarity,
+                                   build_similarity_matrix, geographic_partition, haversine_distances)
+from utils.instrumentation import metrics
+from utils.matrix_store import MatrixStore
+from utils.progress import Progress
+from utils.time_windows import compatible_windows, window_components, window_intervals
+
+CHUNK_SIZE = 50
+# cells of one matrix job for clients that do not state their limit
+MAX_CELLS = CHUNK_SIZE * CHUNK_SIZE
+# pairs whose delivery windows cannot share a route are this many times the largest similarity term apart in
+# build_clusters, and this many times the longest real distance apart for the rebalancer
+WINDOW_PENALTY = 10.0
+
+logger = logging.getLogger(__name__)
 
 
 class ClusterManager:
-    def __init__(self, packages: list[Package], num_of_clusters, warehouse, clustering_model, tomtom_client: TomTomClient):
+    def __init__(self, packages: list[Package], num_of_clusters, warehouse, clustering_model, tomtom_client: TomTomClient,
+                 max_concurrent_jobs=4, matrix_store: MatrixStore = None, max_retries=3, retry_backoff=1.0,
+                 layers=(LENGTH,)):
         self.packages = packages
         self.num_of_clusters = num_of_clusters
         self.warehouse = warehouse
         self.tomtom_client = tomtom_client
         self.clustering_model = clustering_model
+        # number of matrix routing jobs kept in flight, the pace of submissions is set by the client's rate limiter
+        self.max_concurrent_jobs = max_concurrent_jobs
+        # a failed matrix job is retried after retry_backoff * 2^attempt seconds (plus jitter)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        # optional memory-mapped backing file for the dense distance matrix
+        self.matrix_store = matrix_store
+        # routeSummary fields captured by every matrix job (see services.tomtom_client), the first one is the
+        # distance matrix that routes, rebalancing and assign() work on
+        self.layers = tuple(layers)
+        # (len(layers), n, n) stack of the dense matrices, None when the distance matrix was set directly
+        self.metric_layers = None
         self.distance_matrix = None
+        self.similarity_matrix = None
         self.clusters = []
+        # package_id -> row/column of the package in the distance matrix
+        self.package_index = {}
+        self.store = None
+        self._rebuild_package_index()
+        # weights and largest distance of the last build_clusters call, reused to place late packages
+        self.clustering_weights = (0.5, 0.5)
+        self.layer_weights = None
+        self.max_distance = None
+        # packages placed by assign() since the last full clustering, they have no matrix rows yet
+        self.late_packages = []
+        # geographic partition of every matrix row after build_partitioned_clusters, whose distance matrix only
+        # holds the blocks within partitions (and the clusters of moved boundary packages), and the settings of
+        # that call, which recluster() repeats
+        self.partitions = None
+        self.partition_settings = None
+        # neighbours per package of the last build_sparse_distance_matrix, reused when recluster() rebuilds it
+        self.sparse_k = None
+        # after build_windowed_distance_matrix: pairs whose delivery windows are more than window_gap minutes apart
+        # were not fetched and are never clustered together; None when the matrix holds every pair
+        self.window_gap = None
+
+    @property
+    def distance_matrix(self):
+        return self._distance_matrix
+
+    @distance_matrix.setter
+    def distance_matrix(self, matrix):
+        # a matrix set directly (a precomputed matrix, a sparse graph) has no other layers
+        self._distance_matrix = matrix
+        self.metric_layers = None
+        self.window_gap = None
+
+    def _set_matrices(self, matrices):
+        # a (layers, n, n) stack becomes metric_layers with its first layer as the distance matrix
+        if matrices is not None and matrices.ndim == 3:
+            self._distance_matrix = matrices[0]
+            self.metric_layers = matrices
+        else:
+            self.distance_matrix = matrices
+
+    def _dense_matrices(self):
+        return self.metric_layers if self.metric_layers is not None else self.distance_matrix
+
+    def _rebuild_package_index(self):
+        # columnar data of the packages: matrix row i is row self.rows[i] of self.store. Once the store is set,
+        # packages from elsewhere are copied into it, so the row indices held by the clusters stay valid
+        self.store, self.rows = PackageStore.locate(self.packages, self.store)
+        self.package_index = {package_id: i for i, package_id in enumerate(self.store.ids[self.rows])}
+        self._row_order = np.argsort(self.rows, kind="stable")
+
+    def _package_ids(self):
+        return self.store.ids[self.rows].tolist()
+
+    def _matrix_rows(self, indices):
+        # distance matrix rows of store rows, -1 for packages outside the matrix (late packages); searched in the
+        # sorted rows, the store may hold far more packages than the matrix
+        indices = np.asarray(indices, dtype=np.intp)
+        if len(self.rows) == 0:
+            return np.full(len(indices), -1)
+        sorted_rows = self.rows[self._row_order]
+        positions = np.minimum(np.searchsorted(sorted_rows, indices), len(sorted_rows) - 1)
+        return np.where(sorted_rows[positions] == indices, self._row_order[positions], -1)
+
+    def _allocate_distance_matrix(self, shape):
+        if self.matrix_store is None:
+            # metres and seconds are whole numbers, exact in float32, which halves a stack of several layers
+            return np.zeros(shape, dtype=np.float64 if len(shape) == 2 or shape[0] == 1 else np.float32)
+        return self.matrix_store.create(shape)
+
+    def _allocate_similarity_matrix(self, shape):
+        if self.matrix_store is None:
+            return None
+        return MatrixStore(f"{self.matrix_store.path}.similarity", dtype="float32").create(shape)
+
+    def _save_distance_matrix(self):
+        if self.matrix_store is not None:
+            matrices = self._dense_matrices()
+            self.matrix_store.save(matrices, self._package_ids(), self.layers if matrices.ndim == 3 else None,
+                                   self.window_gap)
 
 
     def build_distance_matrix(self):
+        # every layer of self.layers is filled by the same jobs, self.distance_matrix is the first one
         num_packages = len(self.packages)
-        self.distance_matrix = np.zeros((num_packages, num_packages))
-
-        chunks = list(chunk_list(self.packages, 50))
-        print(len(chunks))
-        print([len(c) for c in chunks])
-
-        for i, origins in enumerate(chunks):
-            for j, destinations in enumerate(chunks):
-                submatrix = self.tomtom_client.get_distance_matrix(origins, destinations)
-                for oi, origin in enumerate(origins):
-                    for dj, destination in enumerate(destinations):
-                        oi_idx = self.packages.index(origin)
-                        dj_idx = self.packages.index(destination)
-                        self.distance_matrix[oi_idx, dj_idx] = submatrix[oi][dj]
-                time.sleep(10)
+        self.window_gap = None
+        if self.matrix_store is not None and self.matrix_store.matches(self._package_ids(), self.layers):
+            # fetched by an earlier run for the same packages
+            self._set_matrices(self.matrix_store.open())
+            return self.distance_matrix
+
+        # every job fills one block of the matrix, as few blocks as the provider's cell limit allows
+        max_cells = self._max_cells()
+        blocks = plan_blocks(num_packages, num_packages, max_cells)
+        logger.info("%d matrix jobs of up to %d cells, layers %s", len(blocks), max_cells, ", ".join(self.layers))
+
+        # with a matrix store every finished block is checkpointed, a build that died resumes with the missing ones
+        completed = None
+        layout = {"max_cells": max_cells, "layers": list(self.layers)}
+        if self.matrix_store is not None:
+            completed = self.matrix_store.load_checkpoint(self._package_ids(), layout)
+        if completed is not None:
+            self._set_matrices(self.matrix_store.open())
+            logger.info("Resuming distance matrix build: %d of %d chunks already fetched", len(completed), len(blocks))
+            blocks = [(rows, cols) for rows, cols in blocks if (rows.start, cols.start) not in completed]
+        else:
+            self._set_matrices(self._allocate_distance_matrix((len(self.layers), num_packages, num_packages)))
+            if self.matrix_store is not None:
+                self.matrix_store.start_checkpoint(self._package_ids(), layout)
+
+        self._fetch_blocks(blocks, checkpoint=self.matrix_store is not None)
+        self._save_distance_matrix()
+        if self.matrix_store is not None:
+            self.matrix_store.clear_checkpoint()
+        return self.distance_matrix
+
+    def build_windowed_distance_matrix(self, max_gap=60):
+        # build_distance_matrix without the pairs whose delivery windows are more than max_gap minutes apart,
+        # which no route can serve together (by default a route waits up to an hour between two windows). Origins
+        # are taken in the order of their windows, so the destinations of one job are the compatible packages of
+        # a few similar windows. Pairs that were not fetched are NaN, the matrix only holds real road data
+        num_packages = len(self.packages)
+        self.window_gap = None
+        if self.matrix_store is not None and self.matrix_store.matches(self._package_ids(), self.layers, max_gap):
+            self._set_matrices(self.matrix_store.open())
+            self.window_gap = max_gap
+            return self.distance_matrix
+
+        starts, ends = self._window_intervals()
+        order = np.lexsort((ends, starts))
+        matrices = self._allocate_distance_matrix((len(self.layers), num_packages, num_packages))
+        if not np.issubdtype(matrices.dtype, np.floating):
+            raise ValueError(f"A pruned distance matrix marks missing pairs with NaN, {matrices.dtype} cannot hold it")
+        for start, stop in chunk_ranges(num_packages, 1024):
+            matrices[:, start:stop] = np.nan
+        self._set_matrices(matrices)
+        self.window_gap = max_gap
+
+        max_cells = self._max_cells()
+        jobs = []
+        cells = 0
+        for start, stop in chunk_ranges(num_packages, CHUNK_SIZE):
+            origins = order[start:stop]
+            compatible = compatible_windows(starts[origins], ends[origins], starts, ends, max_gap)
+            destinations = np.flatnonzero(compatible.any(axis=0))
+            cells += len(origins) * len(destinations)
+            for col_start, col_stop in chunk_ranges(len(destinations), max(max_cells // len(origins), 1)):
+                cols = destinations[col_start:col_stop]
+                jobs.append(([self.packages[i] for i in origins], [self.packages[j] for j in cols], matrices,
+                             origins[:, None], cols[None, :]))
+        metrics.increment("pruned_cells", num_packages ** 2 - cells)
+        logger.info("Time-window pruned distance matrix: %d jobs, %d of %d cells", len(jobs), cells,
+                    num_packages ** 2)
+        self._run_jobs(jobs)
+        self._save_distance_matrix()
+        return self.distance_matrix
+
+    def _window_intervals(self):
+        return window_intervals(self.store.opening_minutes[self.rows], self.store.closing_minutes[self.rows])
+
+    def _window_masks(self, chunk_size=1024):
+        # (start, stop, mask of the rows start:stop against all columns) of the pairs compatible under window_gap
+        starts, ends = self._window_intervals()
+        for start, stop in chunk_ranges(len(self.packages), chunk_size):
+            yield start, stop, compatible_windows(starts[start:stop], ends[start:stop], starts, ends, self.window_gap)
+
+    def _compatible_max(self, matrix):
+        # largest value of a dense matrix over the pairs of compatible windows
+        return max((float(np.max(matrix[start:stop][compatible], initial=0.0))
+                    for start, stop, compatible in self._window_masks()), default=0.0)
+
+    def _max_cells(self):
+        return getattr(self.tomtom_client, "max_cells", MAX_CELLS)
+
+    def _block_jobs(self, origins, destinations, target):
+        # jobs filling `target` (len(origins) x len(destinations)) with the planned blocks
+        return [([self.packages[i] for i in origins[rows]], [self.packages[j] for j in destinations[cols]],
+                 target, rows, cols)
+                for rows, cols in plan_blocks(len(origins), len(destinations), self._max_cells())]
+
+    def _fetch_blocks(self, blocks, checkpoint=False):
+        # blocks are (row slice, column slice) pairs of self.distance_matrix, filled in every metric layer
+        matrices = self._dense_matrices()
+
+        def record(rows, cols):
+            self.matrix_store.record_chunk(matrices, rows.start, cols.start)
+
+        self._run_jobs([(self.packages[rows], self.packages[cols], matrices, rows, cols)
+                        for rows, cols in blocks], on_done=record if checkpoint else None)
+
+    def _fetch_with_retries(self, origins, destinations, layers=None):
+        # layers=None fetches the distance matrix alone; packages at the same coordinates (several deliveries to
+        # one address) are requested once and share the fetched row or column
+        unique_origins, origin_inverse = unique_locations(origins)
+        unique_destinations, destination_inverse = unique_locations(destinations)
+        for attempt in range(self.max_retries + 1):
+            try:
+                if layers is None:
+                    result = self.tomtom_client.get_distance_matrix(unique_origins, unique_destinations)
+                else:
+                    result = self.tomtom_client.get_metric_matrices(unique_origins, unique_destinations, layers)
+                if origin_inverse is None and destination_inverse is None:
+                    return result
+                result = np.asarray(result)
+                if origin_inverse is not None:
+                    result = result[..., origin_inverse, :]
+                return result if destination_inverse is None else result[..., destination_inverse]
+            except (RuntimeError, requests.RequestException) as error:
+                if attempt == self.max_retries:
+                    raise
+                # the jitter keeps the jobs that failed together from retrying together
+                delay = self.retry_backoff * 2 ** attempt * (1 + random.random())
+                logger.warning("Matrix job failed (%s), retry %d/%d in %.1f s", error, attempt + 1, self.max_retries,
+                               delay)
+                metrics.increment("retries")
+                time.sleep(delay)
+
+    def _run_jobs(self, jobs, on_done=None):
+        # jobs are (origins, destinations, target array, target rows, target columns), on_done(rows, cols) runs
+        # after a result is written; a job that still fails after its retries does not stop the others, the
+        # error is raised once all of them have finished. A 3-d target is a stack of self.layers and gets
+        # every layer of the job. The fetch span is the wall-clock time of all jobs together
+        progress = Progress("Distance matrix chunks", len(jobs))
+        errors = []
+        with metrics.span("fetch"), ThreadPoolExecutor(max_workers=self.max_concurrent_jobs) as executor:
+            futures = {
+                executor.submit(self._fetch_with_retries, origins, destinations,
+                                self.layers if target.ndim == 3 and self.layers != (LENGTH,) else None):
+                    (target, rows, cols)
+                for origins, destinations, target, rows, cols in jobs
+            }
+            # results are written as soon as each job finishes
+            for future in as_completed(futures):
+                target, rows, cols = futures[future]
+                try:
+                    result = future.result()
+                except (RuntimeError, requests.RequestException) as error:
+                    errors.append(error)
+                    continue
+                with metrics.span("assemble"):
+                    target[..., rows, cols] = result
+                if on_done is not None:
+                    on_done(rows, cols)
+                progress.update()
+        if errors:
+            metrics.increment("failed_jobs", len(errors))
+            raise RuntimeError(f"{len(errors)} of {len(jobs)} matrix jobs failed, last error: {errors[-1]}")
+
+    def add_packages(self, packages: list[Package]):
+        if sparse.issparse(self.distance_matrix):
+            raise ValueError("Incremental updates need a dense distance matrix, rebuild the sparse graph instead")
+
+        num_old = len(self.packages)
+        num_new = len(packages)
+        self.packages = self.packages + list(packages)
+        self._rebuild_package_index()
+
+        matrices = self._dense_matrices()
+        grown = self._allocate_distance_matrix(matrices.shape[:-2] + (num_old + num_new, num_old + num_new))
+        grown[..., :num_old, :num_old] = matrices
+        self._set_matrices(grown)
+
+        # only new x all and old x new cells are fetched
+        max_cells = self._max_cells()
+        blocks = [(slice(num_old + rows.start, num_old + rows.stop), cols)
+                  for rows, cols in plan_blocks(num_new, num_old + num_new, max_cells)]
+        blocks += [(rows, slice(num_old + cols.start, num_old + cols.stop))
+                   for rows, cols in plan_blocks(num_old, num_new, max_cells)]
+        self._fetch_blocks(blocks)
+        self._save_distance_matrix()
         return self.distance_matrix
 
+    def remove_packages(self, packages: list[Package]):
+        removed_ids = {p.get_id() for p in packages}
+        keep = np.array([p.get_id() not in removed_ids for p in self.packages], dtype=bool)
+        # late packages have no matrix row yet, a cancelled one must not come back with the next recluster()
+        removed_late = [p for p in self.late_packages if p.get_id() in removed_ids]
+        self.late_packages = [p for p in self.late_packages if p.get_id() not in removed_ids]
+        removed_rows = np.concatenate([self.rows[~keep], self.store.adopt(removed_late)])
+
+        self.packages = [p for p, kept in zip(self.packages, keep) if kept]
+        self._rebuild_package_index()
+        if sparse.issparse(self.distance_matrix):
+            self.distance_matrix = self.distance_matrix[keep][:, keep]
+            if self.partitions is not None:
+                self.partitions = self.partitions[keep]
+        elif self.distance_matrix is not None:
+            matrices = self._dense_matrices()
+            kept_rows = np.flatnonzero(keep)
+            shrunk = self._allocate_distance_matrix(matrices.shape[:-2] + (len(kept_rows), len(kept_rows)))
+            # copied in row chunks so a memory-mapped matrix is never loaded at once
+            for start, stop in chunk_ranges(len(kept_rows), 1024):
+                shrunk[..., start:stop, :] = matrices[..., kept_rows[start:stop], :][..., keep]
+            self._set_matrices(shrunk)
+            self._save_distance_matrix()
+
+        # clusters that lost members need a new route, and a new medoid when it was removed (recomputed from the
+        # distance matrix when it is needed)
+        for cluster in self.clusters:
+            lost = np.isin(cluster.indices, removed_rows)
+            if lost.any():
+                cluster.indices = cluster.indices[~lost]
+                cluster.set_route(None, None)
+                medoid = cluster.get_medoid()
+                if medoid is not None and medoid.get_id() in removed_ids:
+                    cluster.set_medoid(None)
+        return self.distance_matrix
 
-    def build_clusters(self, distance_weight=0.5, priority_weight=0.5):
-        priorities = [p.get_priority() for p in self.packages]
 
-        normalized_distances = normalize_matrix(self.distance_matrix)
-        normalized_priorities = get_priority_diversity_matrix(priorities)
+    def build_sparse_distance_matrix(self, k=10):
+        # road distances only from every package to its k nearest packages by air, stored as a CSR graph
+        num_packages = len(self.packages)
+        latitudes = self.store.latitude[self.rows]
+        longitudes = self.store.longitude[self.rows]
+        neighbours = k_nearest_neighbours(latitudes, longitudes, k)
+
+        # origins close to each other share most of their candidates, so the destinations of a group of origins
+        # are few; every group is fetched in blocks planned for the provider's cell limit
+        order = spatial_order(latitudes, longitudes)
+        groups, jobs = [], []
+        for start, stop in chunk_ranges(num_packages, CHUNK_SIZE):
+            origin_indices = order[start:stop]
+            destination_indices = np.unique(neighbours[origin_indices])
+            submatrix = np.zeros((len(origin_indices), len(destination_indices)))
+            groups.append((origin_indices, destination_indices, submatrix))
+            jobs += self._block_jobs(origin_indices, destination_indices, submatrix)
+        logger.info("Sparse distance matrix: %d jobs for k=%d", len(jobs), neighbours.shape[1])
+        self._run_jobs(jobs)
+
+        rows, cols, values = [], [], []
+        for origin_indices, destination_indices, submatrix in groups:
+            # keep only the cells that belong to an origin's k nearest candidates
+            is_candidate = (neighbours[origin_indices][:, :, None] == destination_indices[None, None, :]).any(axis=1)
+            oi, dj = np.nonzero(is_candidate)
+            rows.append(origin_indices[oi])
+            cols.append(destination_indices[dj])
+            values.append(submatrix[oi, dj])
+
+        # packages at the same address are 0 m apart, keep those edges as explicit entries of 1 m
+        values = np.maximum(np.concatenate(values), 1.0) if values else np.empty(0)
+        rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.intp)
+        cols = np.concatenate(cols) if cols else np.empty(0, dtype=np.intp)
+        self.distance_matrix = sparse.csr_matrix((values, (rows, cols)), shape=(num_packages, num_packages))
+        self.sparse_k = k
+        self.partitions = None
+        return self.distance_matrix
 
-        similarity = (distance_weight * normalized_distances) + (priority_weight * normalized_priorities)
 
-        labels = self.clustering_model.fit(similarity)
+    def build_clusters(self, distance_weight=0.5, priority_weight=0.5, layer_weights=None):
+        # layer_weights ({layer: weight}, e.g. {LENGTH: 0.5, TRAVEL_TIME: 0.5}) blends the fetched metric layers,
+        # each scaled by its largest value, into the matrix weighted by distance_weight; None uses the distances
+        # after build_windowed_distance_matrix the scales come from compatible pairs only, incompatible pairs
+        # (NaN when they were not fetched) get a cannot-link similarity, and window groups that share no
+        # compatible pair are fitted separately
+        priorities = self.store.priority[self.rows]
+        windowed = self.window_gap is not None
 
-        grouped_packages = [[] for _ in range(self.num_of_clusters)]
-        for i, lbl in enumerate(labels):
-            grouped_packages[lbl].append(self.packages[i])
-            self.packages[i].set_cluster(lbl)
+        with metrics.span("normalize"):
+            if layer_weights is not None:
+                similarity = self._blend_layers(layer_weights)
+                scale = self._compatible_max(similarity) if windowed else None
+                similarity = build_similarity_matrix(similarity, priorities, distance_weight, priority_weight,
+                                                     out=similarity, max_distance=scale)
+            elif sparse.issparse(self.distance_matrix):
+                similarity = build_sparse_similarity(self.distance_matrix, priorities, distance_weight,
+                                                     priority_weight)
+            else:
+                num_packages = len(self.packages)
+                scale = self._compatible_max(self.distance_matrix) if windowed else None
+                similarity = build_similarity_matrix(self.distance_matrix, priorities, distance_weight,
+                                                     priority_weight,
+                                                     out=self._allocate_similarity_matrix((num_packages, num_packages)),
+                                                     max_distance=scale)
+            if windowed:
+                cannot_link = WINDOW_PENALTY * (distance_weight + priority_weight or 1.0)
+                for start, stop, compatible in self._window_masks():
+                    similarity[start:stop][~compatible] = cannot_link
+        self.similarity_matrix = similarity
+        self.clustering_weights = (distance_weight, priority_weight)
+        self.layer_weights = layer_weights
+        if not sparse.issparse(self.distance_matrix):
+            self.partitions = None
+        if windowed:
+            self.max_distance = self._compatible_max(self.distance_matrix)
+        else:
+            self.max_distance = float(self.distance_matrix.max())
 
-        self.clusters = [Cluster(i, group, self.warehouse) for i, group in enumerate(grouped_packages)]
+        with metrics.span("fit"):
+            components = window_components(*self._window_intervals(), self.window_gap) if windowed else None
+            if components is not None and 1 < int(components.max()) + 1 <= self.num_of_clusters:
+                labels, medoid_indices = self._fit_components(similarity, components)
+            else:
+                labels = self.clustering_model.fit(similarity)
+                # medoid-based models give every cluster a natural anchor package
+                medoid_indices = getattr(self.clustering_model, "medoid_indices_", None)
+
+        self.store.cluster[self.rows] = labels
+        self.clusters = [Cluster.from_indices(i, self.store, indices, self.warehouse)
+                         for i, indices in enumerate(self.store.group_by_cluster(self.rows, self.num_of_clusters))]
+
+        if medoid_indices is not None:
+            for cluster, medoid_index in zip(self.clusters, medoid_indices):
+                if medoid_index is not None:
+                    cluster.set_medoid(self.packages[medoid_index])
+        self.late_packages = []
+
+    def _fit_components(self, similarity, components):
+        # every window group gets clusters in proportion to its size and a fit of its own, like the partitions of
+        # build_partitioned_clusters; medoids the model did not provide are None and found by _get_anchors
+        members = [np.flatnonzero(components == component) for component in range(int(components.max()) + 1)]
+        counts = allocate_clusters([len(indices) for indices in members], self.num_of_clusters)
+        labels = np.empty(len(components), dtype=np.intp)
+        medoids = []
+        for indices, count in zip(members, counts):
+            model = copy.deepcopy(self.clustering_model)
+            model.n_clusters = count
+            group_labels, group_medoids = fit_partition(model, np.asarray(similarity[np.ix_(indices, indices)]))
+            labels[indices] = group_labels + len(medoids)
+            num_labels = int(group_labels.max()) + 1
+            medoids += [None] * num_labels if group_medoids is None else list(indices[group_medoids])
+        return labels, medoids
+
+    def _blend_layers(self, layer_weights):
+        unknown = [layer for layer in layer_weights if layer not in self.layers]
+        if self.metric_layers is None or unknown:
+            raise ValueError(f"Layers {unknown or list(layer_weights)} were not fetched, build the distance matrix "
+                             f"with layers={tuple(layer_weights)}")
+        num_packages = len(self.packages)
+        out = self._allocate_similarity_matrix((num_packages, num_packages))
+        # the blend is written into the similarity matrix, which build_similarity_matrix then fills in place
+        if out is None:
+            out = np.empty((num_packages, num_packages))
+        maxima = None
+        if self.window_gap is not None:
+            maxima = [self._compatible_max(layer) for layer in self.metric_layers]
+        return blend_layers(self.metric_layers, [layer_weights.get(layer, 0.0) for layer in self.layers], out=out,
+                            maxima=maxima)
+
+    def build_partitioned_clusters(self, max_partition_size=500, distance_weight=0.5, priority_weight=0.5,
+                                   max_workers=None, repair_boundaries=True):
+        # divide and conquer for city-scale package sets: geographic partitions of at most max_partition_size
+        # packages get their own road matrix and clustering fit (in worker processes), so the matrix costs
+        # sum(partition size²) cells instead of n². The result is a block-diagonal sparse distance matrix.
+        # Every partition needs a cluster of its own, so with fewer than n / max_partition_size clusters the
+        # partitions grow beyond max_partition_size (a warning is logged): each cluster needs the road distances
+        # between all its members for its route, which no smaller blocks could provide
+        num_packages = len(self.packages)
+        latitudes, longitudes = self.store.latitude[self.rows], self.store.longitude[self.rows]
+        num_partitions = min(-(-num_packages // max_partition_size), self.num_of_clusters)
+        if num_partitions * max_partition_size < num_packages:
+            logger.warning("%d clusters allow only %d partitions, %d packages make them larger than "
+                           "max_partition_size=%d (about %d packages each)", self.num_of_clusters, num_partitions,
+                           num_packages, max_partition_size, -(-num_packages // num_partitions))
+        partitions = geographic_partition(latitudes, longitudes, num_partitions)
+        members = [np.flatnonzero(partitions == partition) for partition in range(num_partitions)]
+        cluster_counts = allocate_clusters([len(indices) for indices in members], self.num_of_clusters)
+
+        # road matrices of all partitions, every job stays inside one partition
+        matrices = [np.zeros((len(indices), len(indices))) for indices in members]
+        jobs = [job for indices, matrix in zip(members, matrices) for job in self._block_jobs(indices, indices, matrix)]
+        logger.info("Partitioned distance matrix: %d partitions, %d of %d cells", num_partitions,
+                    sum(len(indices) ** 2 for indices in members), num_packages ** 2)
+        self._run_jobs(jobs)
+
+        priorities = self.store.priority[self.rows]
+        with metrics.span("normalize"):
+            similarities = [build_similarity_matrix(matrix, priorities[indices], distance_weight, priority_weight)
+                            for indices, matrix in zip(members, matrices)]
+        models = [copy.deepcopy(self.clustering_model) for _ in members]
+        for model, count in zip(models, cluster_counts):
+            model.n_clusters = count
+        # the worker processes do not share the registry, the span covers all partition fits
+        with metrics.span("fit"), ProcessPoolExecutor(max_workers=max_workers) as executor:
+            fits = list(executor.map(fit_partition, models, similarities))
+
+        # partition labels are offset into one global numbering, medoids come from the model or the matrix
+        labels = np.empty(num_packages, dtype=np.intp)
+        medoids = []
+        offset = 0
+        for indices, matrix, (partition_labels, medoid_indices) in zip(members, matrices, fits):
+            labels[indices] = partition_labels + offset
+            for label in range(int(partition_labels.max()) + 1 if len(partition_labels) else 0):
+                cluster_rows = np.flatnonzero(partition_labels == label)
+                if medoid_indices is None:
+                    within = matrix[np.ix_(cluster_rows, cluster_rows)]
+                    medoid = cluster_rows[int(np.argmin(within.sum(axis=0) + within.sum(axis=1)))]
+                else:
+                    medoid = medoid_indices[label]
+                medoids.append(indices[medoid])
+            offset += int(partition_labels.max()) + 1 if len(partition_labels) else 0
+        medoids = np.array(medoids)
+
+        rows, cols, values = [], [], []
+        for indices, matrix in zip(members, matrices):
+            rows.append(np.repeat(indices, len(indices)))
+            cols.append(np.tile(indices, len(indices)))
+            values.append(matrix.ravel())
+        if repair_boundaries:
+            extra_rows, extra_cols, extra_values = self._repair_boundaries(labels, medoids, partitions)
+            rows += extra_rows
+            cols += extra_cols
+            values += extra_values
+        self.distance_matrix = _distance_graph(rows, cols, values, num_packages)
+
+        self.similarity_matrix = None
+        self.clustering_weights = (distance_weight, priority_weight)
+        self.layer_weights = None
+        self.partitions = partitions
+        self.partition_settings = {"max_partition_size": max_partition_size, "max_workers": max_workers,
+                                   "repair_boundaries": repair_boundaries}
+        self.max_distance = float(self.distance_matrix.max())
+        self.store.cluster[self.rows] = labels
+        self.clusters = [Cluster.from_indices(i, self.store, indices, self.warehouse)
+                         for i, indices in enumerate(self.store.group_by_cluster(self.rows, len(medoids)))]
+        for cluster, medoid in zip(self.clusters, medoids):
+            cluster.set_medoid(self.packages[medoid])
+        self.late_packages = []
+
+    def _repair_boundaries(self, labels, medoids, partitions):
+        # packages that lie nearer (by air) to the centre of a cluster in another partition than to the centre of
+        # their own cluster are moved there when their road distance to its medoid is shorter too; the cells
+        # between moved packages and their new cluster are fetched so every cluster stays a complete block
+        latitudes, longitudes = self.store.latitude[self.rows], self.store.longitude[self.rows]
+        sizes = np.bincount(labels, minlength=len(medoids))
+        centre_latitudes = np.bincount(labels, weights=latitudes, minlength=len(medoids)) / sizes
+        centre_longitudes = np.bincount(labels, weights=longitudes, minlength=len(medoids)) / sizes
+        nearest_other = np.empty(len(labels), dtype=np.intp)
+        is_candidate = np.zeros(len(labels), dtype=bool)
+        for start, stop in chunk_ranges(len(labels), 4096):
+            to_centres = haversine_distances(latitudes[start:stop], longitudes[start:stop], centre_latitudes,
+                                             centre_longitudes)
+            own = to_centres[np.arange(stop - start), labels[start:stop]]
+            to_centres[partitions[start:stop, None] == partitions[medoids][None, :]] = np.inf
+            nearest_other[start:stop] = np.argmin(to_centres, axis=1)
+            is_candidate[start:stop] = to_centres[np.arange(stop - start), nearest_other[start:stop]] < own
+        candidates = np.flatnonzero(is_candidate)
+        if len(candidates) == 0:
+            return [], [], []
+
+        anchors = np.unique(np.concatenate([medoids[labels[candidates]], medoids[nearest_other[candidates]]]))
+        anchor_column = {anchor: column for column, anchor in enumerate(anchors)}
+        to_anchors = np.zeros((len(candidates), len(anchors)))
+        self._run_jobs(self._block_jobs(candidates, anchors, to_anchors))
+
+        own_columns = [anchor_column[anchor] for anchor in medoids[labels[candidates]]]
+        other_columns = [anchor_column[anchor] for anchor in medoids[nearest_other[candidates]]]
+        rows = np.arange(len(candidates))
+        # a medoid stays in its cluster
+        moving = (to_anchors[rows, other_columns] < to_anchors[rows, own_columns]) & ~np.isin(candidates, medoids)
+        moved = candidates[moving]
+        labels[moved] = nearest_other[moved]
+        logger.info("Boundary repair: %d of %d boundary packages moved", len(moved), len(candidates))
+
+        # moved packages x their new cluster and the rest of the cluster x moved packages
+        jobs, blocks = [], []
+        for cluster in np.unique(labels[moved]):
+            arrived = moved[labels[moved] == cluster]
+            staying = np.setdiff1d(np.flatnonzero(labels == cluster), arrived)
+            everyone = np.concatenate([arrived, staying])
+            for origins, destinations in ((arrived, everyone), (staying, arrived)):
+                block = np.zeros((len(origins), len(destinations)))
+                blocks.append((origins, destinations, block))
+                jobs += self._block_jobs(origins, destinations, block)
+        self._run_jobs(jobs)
+        return ([np.repeat(origins, len(destinations)) for origins, destinations, _ in blocks],
+                [np.tile(destinations, len(origins)) for origins, destinations, _ in blocks],
+                [block.ravel() for _, _, block in blocks])
+
+    def _get_anchors(self):
+        # the medoid of every cluster, computed from the distance matrix when the model did not provide one
+        for cluster in self.clusters:
+            if cluster.get_medoid() is None and cluster.get_cluster_size() > 0:
+                members = self._matrix_rows(cluster.indices)
+                members = members[members >= 0]
+                if sparse.issparse(self.distance_matrix):
+                    totals = self._sparse_distance_totals(members)
+                else:
+                    within = self.distance_matrix[np.ix_(members, members)]
+                    # pairs a pruned matrix did not fetch are NaN and left out
+                    totals = np.nansum(within, axis=0) + np.nansum(within, axis=1)
+                cluster.set_medoid(self.packages[members[int(np.argmin(totals))]])
+        return [cluster for cluster in self.clusters if cluster.get_medoid() is not None]
+
+    def _sparse_distance_totals(self, members, chunk_size=1024):
+        # distances from and to every member summed over the others: a sparse graph does not hold every pair (the
+        # kNN graph), missing pairs count with their air distance instead of 0 m
+        within = self.distance_matrix[np.ix_(members, members)].tocsr()
+        within_transposed = within.T.tocsr()
+        latitudes, longitudes = self.store.latitude[self.rows[members]], self.store.longitude[self.rows[members]]
+        totals = np.zeros(len(members))
+        for start, stop in chunk_ranges(len(members), chunk_size):
+            air = haversine_distances(latitudes[start:stop], longitudes[start:stop], latitudes, longitudes)
+            for stored in [within[start:stop].toarray(), within_transposed[start:stop].toarray()]:
+                # stored distances are at least 1 m, see _distance_graph
+                totals[start:stop] += np.where(stored > 0, stored, air).sum(axis=1)
+        return totals
+
+    def assign(self, package: Package, max_cluster_size=None, drift_threshold=0.1):
+        # places a package that arrived after build_clusters into the best existing cluster, only its distances
+        # to the cluster medoids are fetched; a full re-cluster runs once the late packages exceed drift_threshold
+        # (as a share of clustered packages) or no cluster has room left
+        clusters = [c for c in self._get_anchors() if max_cluster_size is None or c.get_cluster_size() < max_cluster_size]
+        if not clusters or (len(self.late_packages) + 1) / len(self.packages) > drift_threshold:
+            self.late_packages.append(package)
+            self.recluster()
+            return self.clusters[package.get_cluster()]
+
+        anchors = [cluster.get_medoid() for cluster in clusters]
+        # only the 1 x k and k x 1 vectors between the package and the medoids, within the client's cell limit
+        to_anchors, from_anchors = np.zeros((1, len(anchors))), np.zeros((len(anchors), 1))
+        max_cells = self._max_cells()
+        jobs = [([package], anchors[cols], to_anchors, rows, cols)
+                for rows, cols in plan_blocks(1, len(anchors), max_cells)]
+        jobs += [(anchors[rows], [package], from_anchors, rows, cols)
+                 for rows, cols in plan_blocks(len(anchors), 1, max_cells)]
+        self._run_jobs(jobs)
+        road_distances = (to_anchors[0] + from_anchors[:, 0]) / 2
+
+        distance_weight, priority_weight = self.clustering_weights
+        priorities = np.append(self.store.priority[self.rows], package.get_priority())
+        spread = int(priorities.max()) - int(priorities.min())
+        costs = []
+        for cluster, road_distance in zip(clusters, road_distances):
+            # mean priority term of the package against the cluster members, as in the similarity matrix
+            counts = cluster.count_packages_by_priority()
+            diversity = sum(count * (1 - abs(package.get_priority() - priority) / spread if spread else 1)
+                            for priority, count in counts.items()) / max(cluster.get_cluster_size(), 1)
+            costs.append(distance_weight * road_distance / (self.max_distance or 1) + priority_weight * diversity)
+
+        best = clusters[int(np.argmin(costs))]
+        best.add_package(package)
+        package.set_cluster(best.get_id())
+        self.late_packages.append(package)
+        return best
+
+    def recluster(self):
+        # late packages get their matrix rows and columns, then everything is clustered again
+        distance_weight, priority_weight = self.clustering_weights
+        late_packages = [p for p in self.late_packages if p.get_id() not in self.package_index]
+        if self.partitions is not None:
+            # partitioned clusters are partitioned, fetched and fitted again with the late packages included
+            if late_packages:
+                self.packages = self.packages + late_packages
+                self._rebuild_package_index()
+            self.build_partitioned_clusters(distance_weight=distance_weight, priority_weight=priority_weight,
+                                            **self.partition_settings)
+            return
+        if late_packages and sparse.issparse(self.distance_matrix):
+            self.packages = self.packages + late_packages
+            self._rebuild_package_index()
+            self.build_sparse_distance_matrix(self.sparse_k or 10)
+        elif late_packages:
+            self.add_packages(late_packages)
+        self.build_clusters(distance_weight, priority_weight, self.layer_weights)
+
+    def rebalance(self, min_size=None, max_size=None, max_per_priority=None, time_budget=1.0, swaps=True):
+        # moves and swaps packages between the clusters of build_clusters until every cluster holds between
+        # min_size and max_size packages and at most max_per_priority[p] packages of priority p, keeping
+        # the within-cluster road distances low; stops after time_budget seconds
+        if sparse.issparse(self.distance_matrix):
+            raise ValueError("Rebalancing needs a dense distance matrix")
+
+        distance_matrix = self.distance_matrix
+        if self.window_gap is not None:
+            # a copy in which incompatible windows are far apart, so that no move or swap brings them together
+            distance_matrix = np.array(distance_matrix, dtype=np.float64)
+            penalty = WINDOW_PENALTY * self._compatible_max(distance_matrix)
+            for start, stop, compatible in self._window_masks():
+                distance_matrix[start:stop][~compatible] = penalty
+        rebalancer = ClusterRebalancer(distance_matrix, self.store.cluster[self.rows], len(self.clusters),
+                                       priorities=self.store.priority[self.rows], min_size=min_size,
+                                       max_size=max_size, max_per_priority=max_per_priority)
+        cost_before = rebalancer.cost()
+        labels = rebalancer.run(time_budget, swaps)
+
+        # late packages keep their cluster, they are not part of the matrix
+        self.store.cluster[self.rows] = labels
+        rows = np.concatenate([self.rows, self.store.adopt(self.late_packages)])
+        for cluster, indices in zip(self.clusters, self.store.group_by_cluster(rows, len(self.clusters))):
+            if not np.array_equal(np.sort(cluster.indices), np.sort(indices)):
+                cluster.set_route(None, None)
+            medoid = cluster.get_medoid()
+            if medoid is not None and not np.isin(medoid.index, indices):
+                # recomputed from the distance matrix when it is needed
+                cluster.set_medoid(None)
+            cluster.indices = indices
+        return {"moves": rebalancer.moves, "swaps": rebalancer.swaps, "cost_before": cost_before,
+                "cost_after": rebalancer.cost()}
+
+    def optimize_routes(self, max_workers=None):
+        # local route for every cluster on its submatrix of road distances, clusters are solved in parallel
+        if sparse.issparse(self.distance_matrix):
+            # a sparse matrix works when it holds every cell inside each cluster (build_partitioned_clusters)
+            for cluster in self.clusters:
+                members = self._matrix_rows(cluster.indices)
+                members = members[members >= 0]
+                if self.distance_matrix[np.ix_(members, members)].nnz < len(members) * (len(members) - 1):
+                    raise ValueError("Route optimization needs the road distances between all packages of a cluster")
+        elif self.window_gap is not None:
+            # a pruned matrix holds every pair a route can serve together, clusters that mix incompatible windows
+            # have no road distances between them
+            for cluster in self.clusters:
+                members = self._matrix_rows(cluster.indices)
+                members = members[members >= 0]
+                if np.isnan(self.distance_matrix[np.ix_(members, members)]).any():
+                    raise ValueError(f"Cluster {cluster.get_id()} mixes delivery windows more than "
+                                     f"{self.window_gap} minutes apart, which no route can serve")
+
+        labels = np.full(len(self.packages), -1)
+        for cluster in self.clusters:
+            # late packages have no matrix row until the next re-cluster
+            members = self._matrix_rows(cluster.indices)
+            labels[members[members >= 0]] = cluster.get_id()
+        assigned = np.flatnonzero(labels >= 0)
+
+        routes = solve_cluster_routes(self.distance_matrix[np.ix_(assigned, assigned)], labels[assigned], max_workers)
+        for cluster in self.clusters:
+            if cluster.get_id() in routes:
+                route, length = routes[cluster.get_id()]
+                cluster.set_route([self.packages[assigned[i]] for i in route], length)
+        return {int(cluster_id): length for cluster_id, (_, length) in routes.items()}
+
+
+def unique_locations(packages):
+    # (one package per distinct coordinate, index of every package's coordinate among them), the index is None
+    # when all coordinates are distinct
+    coordinates = np.array([(package.latitude, package.longitude) for package in packages]).reshape(-1, 2)
+    _, first, inverse = np.unique(coordinates, axis=0, return_index=True, return_inverse=True)
+    if len(first) == len(coordinates):
+        return packages, None
+    return [packages[int(i)] for i in first], inverse.ravel()
+
+
+def fit_partition(model, similarity_matrix):
+    # runs in a worker process, one partition of build_partitioned_clusters
+    num_packages = similarity_matrix.shape[0]
+    if model.n_clusters == 1 or model.n_clusters >= num_packages:
+        labels = np.zeros(num_packages, dtype=np.intp) if model.n_clusters == 1 else np.arange(num_packages)
+        return labels, None
+    labels = np.asarray(model.fit(similarity_matrix), dtype=np.intp)
+    return labels, getattr(model, "medoid_indices_", None)
+
+
+def allocate_clusters(partition_sizes, n_clusters):
+    # clusters per partition proportional to its size (largest remainder), at least one each
+    partition_sizes = np.asarray(partition_sizes, dtype=np.float64)
+    shares = partition_sizes / partition_sizes.sum() * n_clusters
+    counts = np.maximum(np.floor(shares).astype(np.intp), 1)
+    while counts.sum() < n_clusters:
+        counts[np.argmax(shares - counts)] += 1
+    while counts.sum() > n_clusters:
+        counts[np.argmax(np.where(counts > 1, counts - shares, -np.inf))] -= 1
+    return counts.tolist()
+
+
+def _distance_graph(rows, cols, values, num_packages):
+    # CSR road distance graph without the diagonal, 0 m between different packages is stored as 1 m
+    rows, cols, values = np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+    off_diagonal = rows != cols
+    return sparse.csr_matrix((np.maximum(values[off_diagonal], 1.0), (rows[off_diagonal], cols[off_diagonal])),
+                             shape=(num_packages, num_packages))
+
+
+def even_ranges(length, parts):
+    # `parts` consecutive ranges covering 0..length whose sizes differ by at most one
+    bounds = np.linspace(0, length, parts + 1).round().astype(int)
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def plan_blocks(num_rows, num_cols, max_cells):
+    # (row slice, column slice) blocks covering a num_rows x num_cols matrix in the fewest jobs of at most
+    # max_cells cells; blocks may be rectangular and the rows and columns are split evenly, so there is no
+    # ragged last chunk (120 x 120 with 2500 cells is 3 x 2 blocks of 40 x 60 instead of 3 x 3 blocks of <= 50 x 50)
+    if num_rows == 0 or num_cols == 0:
+        return []
+    best = None
+    for row_parts in range(1, num_rows + 1):
+        block_rows = -(-num_rows // row_parts)
+        block_cols = min(num_cols, max_cells // block_rows)
+        if block_cols == 0:
+            continue
+        col_parts = -(-num_cols // block_cols)
+        # fewest jobs first, then the squarest blocks
+        key = (row_parts * col_parts, abs(block_rows - -(-num_cols // col_parts)))
+        if best is None or key < best[0]:
+            best = (key, row_parts, col_parts)
+        if block_rows == 1:
+            break
+    _, row_parts, col_parts = best
+    return [(slice(*rows), slice(*cols))
+            for rows in even_ranges(num_rows, row_parts) for cols in even_ranges(num_cols, col_parts)]
 
 
 def chunk_list(lst, size=40):
     for i in range(0, len(lst), size):
         yield lst[i:i + size]
+
+
+def chunk_ranges(length, size=40):
+    for i in range(0, length, size):
+        yield i, min(i + size, length)
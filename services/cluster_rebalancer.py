@@ -0,0 +1,152 @@
+import time
+
+import numpy as np
+
+IMPROVEMENT_TOLERANCE = 1e-9
+
+
+class ClusterRebalancer:
+    # moves and swaps packages between clusters to meet size and priority-mix bounds while keeping the sum of
+    # within-cluster distances low. sums[i, c] (distance of package i to all members of cluster c) is kept up to
+    # date after every move, so a move is scored in O(k) and a swap of one package against all others in O(n)
+    def __init__(self, distance_matrix, labels, n_clusters, priorities=None, min_size=None, max_size=None,
+                 max_per_priority=None):
+        self.distance_matrix = distance_matrix
+        self.labels = np.array(labels, dtype=np.intp)
+        self.n_clusters = n_clusters
+        num_packages = len(self.labels)
+        self.min_size = 0 if min_size is None else min_size
+        self.max_size = num_packages if max_size is None else max_size
+
+        priorities = np.zeros(num_packages) if priorities is None else np.asarray(priorities)
+        levels, self.priority_codes = np.unique(priorities, return_inverse=True)
+        # {priority: most packages of that priority one cluster may hold}
+        max_per_priority = max_per_priority or {}
+        self.priority_caps = np.array([max_per_priority.get(level, num_packages) for level in levels])
+
+        membership = np.zeros((num_packages, n_clusters))
+        membership[np.arange(num_packages), self.labels] = 1
+        self.sums = (distance_matrix @ membership + np.asarray(distance_matrix).T @ membership) / 2
+        self.sizes = membership.sum(axis=0).astype(np.intp)
+        self.priority_counts = np.zeros((n_clusters, len(levels)), dtype=np.intp)
+        np.add.at(self.priority_counts, (self.labels, self.priority_codes), 1)
+        self.moves = 0
+        self.swaps = 0
+
+    def _row(self, index):
+        # symmetric distances of one package to all others
+        return (np.asarray(self.distance_matrix[index], dtype=np.float64)
+                + np.asarray(self.distance_matrix[:, index], dtype=np.float64)) / 2
+
+    def cost(self):
+        # sum of distances between every pair of packages in the same cluster
+        return float(self.sums[np.arange(len(self.labels)), self.labels].sum() / 2)
+
+    def move_deltas(self, index):
+        # change of the cost for moving package `index` into every cluster, np.inf where bounds forbid it
+        source = self.labels[index]
+        deltas = self.sums[index] - self.sums[index, source]
+        priority = self.priority_codes[index]
+        blocked = (self.sizes >= self.max_size) | (self.priority_counts[:, priority] >= self.priority_caps[priority])
+        deltas[blocked] = np.inf
+        deltas[source] = np.inf
+        return deltas
+
+    def move(self, index, target, row=None):
+        source = self.labels[index]
+        row = self._row(index) if row is None else row
+        self.sums[:, source] -= row
+        self.sums[:, target] += row
+        self.sizes[source] -= 1
+        self.sizes[target] += 1
+        priority = self.priority_codes[index]
+        self.priority_counts[source, priority] -= 1
+        self.priority_counts[target, priority] += 1
+        self.labels[index] = target
+        self.moves += 1
+
+    def swap_deltas(self, index):
+        # change of the cost for swapping package `index` with every other package, np.inf where bounds forbid it
+        row = self._row(index)
+        source = self.labels[index]
+        deltas = (self.sums[index, self.labels] - self.sums[index, source] + self.sums[:, source]
+                  - self.sums[np.arange(len(self.labels)), self.labels] - 2 * row)
+        deltas[self.labels == source] = np.inf
+        # a swap only changes priority counts when the two priorities differ
+        priority = self.priority_codes[index]
+        other = self.priority_codes
+        blocked = (other != priority) & (
+            (self.priority_counts[self.labels, priority] >= self.priority_caps[priority])
+            | (self.priority_counts[source, other] >= self.priority_caps[other]))
+        deltas[blocked] = np.inf
+        return deltas, row
+
+    def swap(self, index, other):
+        source, target = self.labels[index], self.labels[other]
+        self.move(index, target)
+        self.move(other, source)
+        self.moves -= 2
+        self.swaps += 1
+
+    def _repair_sizes(self, deadline):
+        # oversized clusters give their cheapest package away, undersized ones take the cheapest package they may
+        while time.perf_counter() < deadline and self.sizes.max() > self.max_size:
+            members = np.flatnonzero(self.labels == np.argmax(self.sizes))
+            deltas = np.array([self.move_deltas(index) for index in members])
+            best = np.unravel_index(np.argmin(deltas), deltas.shape)
+            if not np.isfinite(deltas[best]):
+                break
+            self.move(members[best[0]], best[1])
+
+        while time.perf_counter() < deadline and self.sizes.min() < self.min_size:
+            target = int(np.argmin(self.sizes))
+            donors = np.flatnonzero((self.sizes[self.labels] > self.min_size)
+                                    & (self.priority_counts[target, self.priority_codes]
+                                       < self.priority_caps[self.priority_codes]))
+            if len(donors) == 0:
+                break
+            deltas = self.sums[donors, target] - self.sums[donors, self.labels[donors]]
+            self.move(donors[int(np.argmin(deltas))], target)
+
+    def _repair_priorities(self, deadline):
+        while time.perf_counter() < deadline:
+            over = np.argwhere(self.priority_counts > self.priority_caps[None, :])
+            if len(over) == 0:
+                break
+            cluster, priority = over[0]
+            members = np.flatnonzero((self.labels == cluster) & (self.priority_codes == priority))
+            deltas = np.array([self.move_deltas(index) for index in members])
+            # a smaller cluster is allowed to go under min_size here, the priority bound is the harder constraint
+            best = np.unravel_index(np.argmin(deltas), deltas.shape)
+            if not np.isfinite(deltas[best]):
+                break
+            self.move(members[best[0]], best[1])
+
+    def run(self, time_budget=1.0, swaps=True, max_passes=20):
+        # repairs bound violations first, then improves the cost with moves and swaps until nothing improves,
+        # max_passes is reached or the time budget (seconds) runs out
+        deadline = time.perf_counter() + time_budget
+        self._repair_sizes(deadline)
+        self._repair_priorities(deadline)
+
+        for _ in range(max_passes):
+            improved = False
+            for index in range(len(self.labels)):
+                if time.perf_counter() >= deadline:
+                    return self.labels
+                deltas = self.move_deltas(index)
+                if self.sizes[self.labels[index]] <= self.min_size:
+                    deltas[:] = np.inf
+                target = int(np.argmin(deltas))
+                if deltas[target] < -IMPROVEMENT_TOLERANCE:
+                    self.move(index, target)
+                    improved = True
+                elif swaps:
+                    deltas, _ = self.swap_deltas(index)
+                    other = int(np.argmin(deltas))
+                    if deltas[other] < -IMPROVEMENT_TOLERANCE:
+                        self.swap(index, other)
+                        improved = True
+            if not improved:
+                break
+        return self.labels
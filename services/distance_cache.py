@@ -0,0 +1,116 @@
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+class DistanceCache:
+    def __init__(self, path="distance_cache.sqlite", ttl_seconds=30 * 24 * 3600, max_entries=None, precision=5):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # coordinates are stored as integers rounded to `precision` decimals (5 decimals is roughly 1 metre)
+        self.scale = 10 ** precision
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS distances ("
+            "origin_lat INTEGER, origin_lon INTEGER, destination_lat INTEGER, destination_lon INTEGER, "
+            "route_type TEXT, travel_mode TEXT, metric TEXT, value REAL, fetched_at REAL, "
+            "PRIMARY KEY (origin_lat, origin_lon, destination_lat, destination_lon, route_type, travel_mode, metric)"
+            ") WITHOUT ROWID"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS distances_fetched_at ON distances (fetched_at)")
+        # keys of the block get_matrix looks up, joined against the table in one query
+        self.connection.execute("CREATE TEMP TABLE lookup_origins (position INTEGER, lat INTEGER, lon INTEGER)")
+        self.connection.execute("CREATE TEMP TABLE lookup_destinations (position INTEGER, lat INTEGER, lon INTEGER)")
+        self.connection.commit()
+
+    def _key(self, package):
+        return round(package.latitude * self.scale), round(package.longitude * self.scale)
+
+    def get_matrix(self, origins, destinations, route_type, travel_mode, metric="lengthInMeters"):
+        # missing or expired cells are returned as NaN
+        matrix = np.full((len(origins), len(destinations)), np.nan)
+        min_fetched_at = time.time() - self.ttl_seconds if self.ttl_seconds else 0
+        query = ("SELECT o.position, d.position, distances.value FROM lookup_origins o CROSS JOIN lookup_destinations d "
+                 "JOIN distances ON distances.origin_lat=o.lat AND distances.origin_lon=o.lon "
+                 "AND distances.destination_lat=d.lat AND distances.destination_lon=d.lon "
+                 "AND distances.route_type=? AND distances.travel_mode=? AND distances.metric=? "
+                 "WHERE distances.fetched_at>=?")
+
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute("DELETE FROM lookup_origins")
+            cursor.execute("DELETE FROM lookup_destinations")
+            cursor.executemany("INSERT INTO lookup_origins VALUES (?, ?, ?)",
+                               [(i, *self._key(origin)) for i, origin in enumerate(origins)])
+            cursor.executemany("INSERT INTO lookup_destinations VALUES (?, ?, ?)",
+                               [(j, *self._key(destination)) for j, destination in enumerate(destinations)])
+            found = cursor.execute(query, (route_type, travel_mode, metric, min_fetched_at)).fetchall()
+            if found:
+                oi, dj, values = zip(*found)
+                matrix[list(oi), list(dj)] = values
+
+            hits = int(np.count_nonzero(~np.isnan(matrix)))
+            self.hits += hits
+            self.misses += matrix.size - hits
+        return matrix
+
+    def put_matrix(self, origins, destinations, matrix, route_type, travel_mode, metric="lengthInMeters"):
+        fetched_at = time.time()
+        origin_keys = [self._key(origin) for origin in origins]
+        destination_keys = [self._key(destination) for destination in destinations]
+        rows = [
+            (*origin_key, *destination_key, route_type, travel_mode, metric, float(matrix[oi][dj]), fetched_at)
+            for oi, origin_key in enumerate(origin_keys)
+            for dj, destination_key in enumerate(destination_keys)
+        ]
+
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO distances VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.commit()
+        if self.max_entries:
+            self.evict()
+
+    def warm_from_matrix(self, packages, matrix, route_type="fastest", travel_mode="truck", metric="lengthInMeters"):
+        # e.g. distance_matrix_50_packages together with the packages it was fetched for
+        matrix = np.asarray(matrix)
+        self.put_matrix(packages, packages, matrix[:len(packages), :len(packages)], route_type, travel_mode, metric)
+
+    def evict(self):
+        with self.lock:
+            if self.ttl_seconds:
+                self.connection.execute("DELETE FROM distances WHERE fetched_at<?", (time.time() - self.ttl_seconds,))
+            if self.max_entries:
+                # drop the oldest entries above the limit; the cells of one put_matrix share their fetched_at, ties
+                # are broken by key so exactly the surplus goes
+                surplus = self.connection.execute("SELECT COUNT(*) FROM distances").fetchone()[0] - self.max_entries
+                if surplus > 0:
+                    self.connection.execute(
+                        "DELETE FROM distances WHERE (origin_lat, origin_lon, destination_lat, destination_lon, "
+                        "route_type, travel_mode, metric) IN (SELECT origin_lat, origin_lon, destination_lat, "
+                        "destination_lon, route_type, travel_mode, metric FROM distances "
+                        "ORDER BY fetched_at, origin_lat, origin_lon, destination_lat, destination_lon LIMIT ?)",
+                        (surplus,)
+                    )
+            self.connection.commit()
+
+    def size(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM distances").fetchone()[0]
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "entries": self.size(),
+        }
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,117 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+IMPROVEMENT_TOLERANCE = 1e-9
+
+
+def route_length(distance_matrix, route):
+    # length of the closed tour route[0] -> ... -> route[-1] -> route[0]
+    route = np.asarray(route)
+    return float(distance_matrix[route, np.roll(route, -1)].sum())
+
+
+def nearest_neighbour_route(distance_matrix, start=0):
+    num_stops = distance_matrix.shape[0]
+    visited = np.zeros(num_stops, dtype=bool)
+    route = [start]
+    visited[start] = True
+    for _ in range(num_stops - 1):
+        distances = np.where(visited, np.inf, distance_matrix[route[-1]])
+        route.append(int(np.argmin(distances)))
+        visited[route[-1]] = True
+    return np.array(route)
+
+
+def two_opt(sym_matrix, route, max_passes=50):
+    # reverses the segment between two edges when that shortens the tour, all second edges are scored at once
+    route = route.copy()
+    num_stops = len(route)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(num_stops - 2):
+            a, b = route[i], route[i + 1]
+            # the edge closing the tour is adjacent to the first one when i == 0
+            j = np.arange(i + 2, num_stops - 1 if i == 0 else num_stops)
+            if len(j) == 0:
+                continue
+            c, d = route[j], route[(j + 1) % num_stops]
+            delta = sym_matrix[a, c] + sym_matrix[b, d] - sym_matrix[a, b] - sym_matrix[c, d]
+            best = int(np.argmin(delta))
+            if delta[best] < -IMPROVEMENT_TOLERANCE:
+                route[i + 1:j[best] + 1] = route[i + 1:j[best] + 1][::-1]
+                improved = True
+        if not improved:
+            break
+    return route
+
+
+def or_opt(distance_matrix, route, max_segment_length=3, max_passes=50):
+    # moves runs of 1-3 consecutive stops to the cheapest other position, keeping their direction
+    route = route.copy()
+    num_stops = len(route)
+    for _ in range(max_passes):
+        improved = False
+        for segment_length in range(1, max_segment_length + 1):
+            for i in range(1, num_stops - segment_length + 1):
+                segment = route[i:i + segment_length]
+                previous_stop = route[i - 1]
+                next_stop = route[(i + segment_length) % num_stops]
+                removal_gain = (distance_matrix[previous_stop, segment[0]] + distance_matrix[segment[-1], next_stop]
+                                - distance_matrix[previous_stop, next_stop])
+
+                rest = np.concatenate([route[:i], route[i + segment_length:]])
+                origins, destinations = rest, np.roll(rest, -1)
+                insertion_cost = (distance_matrix[origins, segment[0]] + distance_matrix[segment[-1], destinations]
+                                  - distance_matrix[origins, destinations])
+                # inserting the segment back where it was is not a move
+                insertion_cost[i - 1] = np.inf
+                best = int(np.argmin(insertion_cost))
+                if insertion_cost[best] - removal_gain < -IMPROVEMENT_TOLERANCE:
+                    route = np.concatenate([rest[:best + 1], segment, rest[best + 1:]])
+                    improved = True
+        if not improved:
+            break
+    return route
+
+
+def solve_route(distance_matrix, start=0):
+    # nearest neighbour tour from `start`, improved with 2-opt and Or-opt; returns the stop order and its length
+    distance_matrix = np.asarray(distance_matrix, dtype=np.float64)
+    num_stops = distance_matrix.shape[0]
+    if num_stops <= 3:
+        route = np.roll(np.arange(num_stops), -start)
+        return route, route_length(distance_matrix, route)
+
+    route = nearest_neighbour_route(distance_matrix, start)
+    # road distances are asymmetric, 2-opt reverses segments so it works on the symmetric part
+    route = two_opt((distance_matrix + distance_matrix.T) / 2, route)
+    route = or_opt(distance_matrix, route)
+
+    # the route starts at `start` and is driven in its shorter direction
+    route = np.roll(route, -int(np.flatnonzero(route == start)[0]))
+    reversed_route = np.concatenate([route[:1], route[1:][::-1]])
+    if route_length(distance_matrix, reversed_route) < route_length(distance_matrix, route):
+        route = reversed_route
+    return route, route_length(distance_matrix, route)
+
+
+def solve_cluster_routes(distance_matrix, labels, max_workers=None):
+    # one route per cluster label, the clusters are solved in parallel processes;
+    # returns {label: (package indices in visiting order, route length)}
+    labels = np.asarray(labels)
+    members = {label: np.flatnonzero(labels == label) for label in np.unique(labels)}
+    submatrices = [distance_matrix[np.ix_(indices, indices)] for indices in members.values()]
+    # clusters of a sparse matrix are solved on their dense blocks
+    submatrices = [submatrix.toarray() if sparse.issparse(submatrix) else np.asarray(submatrix)
+                   for submatrix in submatrices]
+
+    if max_workers == 1:
+        solutions = [solve_route(submatrix) for submatrix in submatrices]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            solutions = list(executor.map(solve_route, submatrices))
+
+    return {label: (indices[route], length)
+            for (label, indices), (route, length) in zip(members.items(), solutions)}
@@ -1,14 +1,86 @@
 import json
+import logging
 import math
+import random
+import threading
 import time
 
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils.instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+# metric layers of a matrix routing result, all read from the routeSummary of the same cells
+LENGTH = "lengthInMeters"
+TRAVEL_TIME = "travelTimeInSeconds"
+TRAFFIC_DELAY = "trafficDelayInSeconds"
+METRIC_LAYERS = (LENGTH, TRAVEL_TIME, TRAFFIC_DELAY)
+
+# answers worth repeating the request for: rate limited, or a temporary server error
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class SubmissionRetry(Retry):
+    # a POST creates a (billed) matrix job, so it is only sent again when the job surely was not created: on a 429
+    # or when the connection failed. After a 5xx or a read timeout the job may exist, ClusterManager retries the
+    # whole job instead. GET requests are retried on every status of RETRY_STATUSES and on read errors
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST":
+            return status_code == 429
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def create_session(pool_size=8, max_retries=3, retry_backoff=0.5):
+    # one keep-alive connection per concurrent job (up to pool_size) instead of a new TLS connection per request;
+    # 429 and 5xx answers and failed connections are retried with exponential backoff, honouring Retry-After
+    # (see SubmissionRetry for job submissions)
+    retry = SubmissionRetry(total=max_retries, backoff_factor=retry_backoff, status_forcelist=RETRY_STATUSES,
+                            allowed_methods=frozenset({"GET"}), respect_retry_after_header=True,
+                            raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 
 class TomTomClient:
-    def __init__(self, api_key):
+    def __init__(self, api_key, distance_cache=None, route_type="fastest", travel_mode="truck", rate_limiter=None,
+                 poll_interval=0.5, base_url="https://api.tomtom.com/routing/matrix/2/async", sync_url=None,
+                 max_cells=2500, sync_max_cells=200, session=None, pool_size=8, max_retries=3, timeout=(5, 60),
+                 max_poll_interval=10.0, poll_backoff=1.5, poll_jitter=0.2, adaptive_polling=True, job_timeout=900):
         self.api_key = api_key
-        self.matrix_routing_base_url = "https://api.tomtom.com/routing/matrix/2/async"
+        self.distance_cache = distance_cache
+        self.route_type = route_type
+        self.travel_mode = travel_mode
+        # shared by all threads submitting jobs, see services.rate_limiter.TokenBucket
+        self.rate_limiter = rate_limiter
+        # shared by all threads, pool_size should be at least ClusterManager.max_concurrent_jobs
+        self.session = session if session is not None else create_session(pool_size, max_retries)
+        # (connect, read) seconds of every request
+        self.timeout = timeout
+        # a job's status is first checked when jobs have typically completed (a moving average of the observed
+        # job latencies), then every poll_interval seconds growing by poll_backoff up to max_poll_interval, each
+        # wait varied by +-poll_jitter so concurrent jobs do not poll in lockstep; adaptive_polling=False and
+        # poll_backoff=1 poll at a fixed interval
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.poll_backoff = poll_backoff
+        self.poll_jitter = poll_jitter
+        self.adaptive_polling = adaptive_polling
+        self.job_timeout = job_timeout
+        self.expected_job_latency = None
+        self.latency_lock = threading.Lock()
+        self.matrix_routing_base_url = base_url
+        self.matrix_routing_sync_url = sync_url or base_url.rsplit("/async", 1)[0]
+        # provider limits: cells of one async job, and the largest matrix answered by the synchronous endpoint
+        # (one request, no polling); sync_max_cells=0 sends everything through the async endpoint
+        self.max_cells = max_cells
+        self.sync_max_cells = sync_max_cells
         self.headers = {
             "Content-Type": "application/json",
         }
@@ -18,49 +90,134 @@ class TomTomClient:
         destinations = [{"point": {"latitude": destination.latitude, "longitude": destination.longitude}} for destination in destinations]
         return {"origins": origins, "destinations": destinations}
 
-    def _submit_matrix_routing_request(self, origins, destinations):
+    def _post_matrix_routing_request(self, base_url, origins, destinations):
         request_body = json.dumps(self._generate_matrix_routing_request_body(origins, destinations))
-        url = f"{self.matrix_routing_base_url}?key={self.api_key}&routeType=fastest&travelMode=truck"
-        response = requests.post(url, headers=self.headers, data=request_body)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        url = f"{base_url}?key={self.api_key}&routeType={self.route_type}&travelMode={self.travel_mode}"
+        return self.session.post(url, headers=self.headers, data=request_body, timeout=self.timeout)
+
+    def _request_sync_matrix(self, origins, destinations):
+        with metrics.span("fetch_submit"):
+            response = self._post_matrix_routing_request(self.matrix_routing_sync_url, origins, destinations)
+        metrics.increment("sync_requests")
+        if response.status_code != 200:
+            raise RuntimeError(f"An error occurred during synchronous Matrix routing request: {response.status_code}")
+        return response
+
+    def _submit_matrix_routing_request(self, origins, destinations):
+        with metrics.span("fetch_submit"):
+            response = self._post_matrix_routing_request(self.matrix_routing_base_url, origins, destinations)
+        metrics.increment("api_jobs")
 
         if response.status_code != 202:
             raise RuntimeError(f"An error occurred during Matrix routing submission request: {response.status_code}")
 
-        print(f"Matrix routing request submitted: {response.json()}")
-        return response.json()["jobId"]
-
-    def _poll_matrix_routing_result(self, job_id: str):
-        status_url = f"{self.matrix_routing_base_url}/{job_id}?key={self.api_key}"
-        download_url = f"{self.matrix_routing_base_url}/{job_id}/result?key={self.api_key}"
+        job_id = response.json()["jobId"]
+        logger.debug("Matrix routing job %s submitted (%dx%d)", job_id, len(origins), len(destinations))
+        return job_id
 
+    def _poll_delays(self):
+        # seconds to wait before each status check of a job
+        with self.latency_lock:
+            expected = self.expected_job_latency if self.adaptive_polling else None
+        yield expected or 0.0
+        # jobs that are usually quick are checked again sooner
+        interval = self.poll_interval if not expected else min(self.poll_interval, max(0.25 * expected, 0.05))
         while True:
-            status_response = requests.get(status_url)
-            if status_response.status_code != 200:
-                raise RuntimeError(f"An error occurred during Matrix routing request: {status_response.status_code}")
-            state = status_response.json()["state"]
-            if state == "Completed":
-                break
-            elif state == "Failed":
-                raise RuntimeError(f"An error occurred during Matrix routing request: {status_response.json()}")
-            time.sleep(2)
-            print("sleeping...")
+            yield interval * random.uniform(1 - self.poll_jitter, 1 + self.poll_jitter)
+            interval = min(interval * self.poll_backoff, self.max_poll_interval)
+
+    def _record_job_latency(self, seconds, smoothing=0.3):
+        with self.latency_lock:
+            if self.expected_job_latency is None:
+                self.expected_job_latency = seconds
+            else:
+                self.expected_job_latency += smoothing * (seconds - self.expected_job_latency)
 
-        return requests.get(download_url)
+    def _poll_matrix_routing_result(self, job_id: str, submitted_at=None):
+        status_url = f"{self.matrix_routing_base_url}/{job_id}?key={self.api_key}"
+        submitted_at = time.monotonic() if submitted_at is None else submitted_at
+
+        last_check = submitted_at
+        with metrics.span("fetch_poll"):
+            for delay in self._poll_delays():
+                if time.monotonic() + delay - submitted_at > self.job_timeout:
+                    raise RuntimeError(f"Matrix routing job {job_id} did not complete in {self.job_timeout} s")
+                time.sleep(delay)
+                previous_check, last_check = last_check, time.monotonic()
+                status_response = self.session.get(status_url, timeout=self.timeout)
+                metrics.increment("poll_iterations")
+                if status_response.status_code != 200:
+                    raise RuntimeError(f"An error occurred during Matrix routing request: "
+                                       f"{status_response.status_code}")
+                state = status_response.json()["state"]
+                if state == "Completed":
+                    break
+                elif state == "Failed":
+                    raise RuntimeError(f"An error occurred during Matrix routing request: {status_response.json()}")
+                logger.debug("Matrix routing job %s is %s", job_id, state)
+        # the job completed between the last two checks
+        self._record_job_latency((previous_check + last_check) / 2 - submitted_at)
 
-    def _response_to_result_matrix(self, response: requests.Response, m: int, n: int):
-        data = response.json()["data"]
+    def _download_matrix_routing_result(self, job_id: str):
+        # streamed, so the gzip-encoded result (the session asks for gzip) is decompressed as it arrives
+        return self.session.get(f"{self.matrix_routing_base_url}/{job_id}/result?key={self.api_key}",
+                                timeout=self.timeout, stream=True)
 
-        distance_matrix = [[0] * n for _ in range(m)]
+    def _response_to_result_matrix(self, response: requests.Response, m: int, n: int, layers=(LENGTH,)):
+        # (len(layers), m, n) array, one m x n matrix per routeSummary field in `layers`
+        try:
+            if response.status_code != 200:
+                raise RuntimeError(f"An error occurred during Matrix routing download: {response.status_code}")
+            # parsed straight from the UTF-8 bytes, without decoding the whole body to text first
+            data = json.loads(response.content)["data"]
+        finally:
+            # a streamed download keeps its pooled connection until the response is closed
+            response.close()
 
-        for row in data:
-            origin_idx = row["originIndex"]
-            dest_idx = row["destinationIndex"]
-            distance_matrix[origin_idx][dest_idx] = row["routeSummary"]["lengthInMeters"]
+        matrices = np.zeros((len(layers), m, n))
+        if data:
+            cells = np.array([(row["originIndex"], row["destinationIndex"],
+                               *(row["routeSummary"][layer] for layer in layers)) for row in data])
+            matrices[:, cells[:, 0].astype(int), cells[:, 1].astype(int)] = cells[:, 2:].T
 
-        print(f"Distance matrix: {distance_matrix}")
-        return distance_matrix
+        return matrices
 
     def get_distance_matrix(self, origins, destinations):
+        return self.get_metric_matrices(origins, destinations, (LENGTH,))[0]
+
+    def get_metric_matrices(self, origins, destinations, layers=METRIC_LAYERS):
+        # every layer of the result comes from the same TomTom job, cached layers are only fetched again when
+        # one of them misses a cell
+        if self.distance_cache is None:
+            return self._fetch_distance_matrix(origins, destinations, layers)
+
+        matrices = np.stack([self.distance_cache.get_matrix(origins, destinations, self.route_type, self.travel_mode,
+                                                            layer) for layer in layers])
+        missing = np.isnan(matrices).any(axis=0)
+        if missing.any():
+            # only rows and columns that contain a missing cell are sent to TomTom
+            rows = np.flatnonzero(missing.any(axis=1))
+            cols = np.flatnonzero(missing.any(axis=0))
+            missing_origins = [origins[i] for i in rows]
+            missing_destinations = [destinations[j] for j in cols]
+            submatrices = self._fetch_distance_matrix(missing_origins, missing_destinations, layers)
+            for layer, submatrix in zip(layers, submatrices):
+                self.distance_cache.put_matrix(missing_origins, missing_destinations, submatrix,
+                                               self.route_type, self.travel_mode, layer)
+            matrices[:, rows[:, None], cols[None, :]] = submatrices
+        return matrices
+
+    def _fetch_distance_matrix(self, origins, destinations, layers=(LENGTH,)):
+        metrics.increment("cells", len(origins) * len(destinations))
+        if len(origins) * len(destinations) <= self.sync_max_cells:
+            response = self._request_sync_matrix(origins, destinations)
+            # the synchronous response already carries the matrix, only parsing it counts as the download
+            with metrics.span("fetch_download"):
+                return self._response_to_result_matrix(response, len(origins), len(destinations), layers)
         job_id = self._submit_matrix_routing_request(origins, destinations)
-        response = self._poll_matrix_routing_result(job_id)
-        return self._response_to_result_matrix(response, len(origins), len(destinations))
+        self._poll_matrix_routing_result(job_id)
+        with metrics.span("fetch_download"):
+            response = self._download_matrix_routing_result(job_id)
+            return self._response_to_result_matrix(response, len(origins), len(destinations), layers)
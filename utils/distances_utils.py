@@ -1,9 +1,147 @@
+import hashlib
+
 import numpy as np
+from scipy import sparse
 
-def normalize_matrix(matrix):
-    return matrix/np.max(matrix)
+def normalize_matrix(matrix, out=None):
+    # compact (float32/uint32) matrices are normalised to float32 instead of being promoted to float64
+    dtype = np.float32 if np.asarray(matrix).dtype.itemsize <= 4 else np.float64
+    return np.divide(matrix, np.max(matrix), out=out, dtype=dtype)
 
 def get_priority_diversity_matrix(priorities):
     priority_diversity_matrix  = np.abs(np.subtract.outer(priorities, priorities))
     max_priority_matrix  = np.max(priority_diversity_matrix)
     return 1 - priority_diversity_matrix / max_priority_matrix if max_priority_matrix > 0 else np.ones_like(priority_diversity_matrix)
+
+
+EARTH_RADIUS_METERS = 6371008.8
+
+def haversine_distances(latitudes_a, longitudes_a, latitudes_b, longitudes_b):
+    # great-circle distance in metres between every point of a (rows) and every point of b (columns)
+    lat_a = np.radians(np.asarray(latitudes_a, dtype=np.float64))[:, None]
+    lon_a = np.radians(np.asarray(longitudes_a, dtype=np.float64))[:, None]
+    lat_b = np.radians(np.asarray(latitudes_b, dtype=np.float64))[None, :]
+    lon_b = np.radians(np.asarray(longitudes_b, dtype=np.float64))[None, :]
+
+    h = np.sin((lat_b - lat_a) / 2) ** 2 + np.cos(lat_a) * np.cos(lat_b) * np.sin((lon_b - lon_a) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+def k_nearest_neighbours(latitudes, longitudes, k, chunk_size=1024):
+    # indices of the k closest packages (by haversine distance) for every package, the package itself excluded
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    num_packages = len(latitudes)
+    k = min(k, num_packages - 1)
+    neighbours = np.empty((num_packages, k), dtype=np.intp)
+
+    for start in range(0, num_packages, chunk_size):
+        stop = min(start + chunk_size, num_packages)
+        distances = haversine_distances(latitudes[start:stop], longitudes[start:stop], latitudes, longitudes)
+        distances[np.arange(stop - start), np.arange(start, stop)] = np.inf
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        # keep neighbours sorted from the closest one
+        order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1)
+        neighbours[start:stop] = np.take_along_axis(nearest, order, axis=1)
+    return neighbours
+
+def spatial_order(latitudes, longitudes, cell_size=0.01):
+    # walks a grid of `cell_size` degree bands in a serpentine so that consecutive packages are close to each other
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    bands = np.floor((latitudes - latitudes.min()) / cell_size).astype(np.int64)
+    serpentine_longitudes = np.where(bands % 2 == 0, longitudes, -longitudes)
+    return np.lexsort((serpentine_longitudes, bands))
+
+def geographic_partition(latitudes, longitudes, num_partitions):
+    # recursive coordinate bisection: every group is cut across its longer side (in metres) at the quantile that
+    # gives each half a share of the packages proportional to the number of partitions it is split into
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    labels = np.zeros(len(latitudes), dtype=np.intp)
+    groups = [(np.arange(len(latitudes)), 0, num_partitions)]
+    while groups:
+        indices, first_label, parts = groups.pop()
+        if parts == 1 or len(indices) == 0:
+            labels[indices] = first_label
+            continue
+        lat, lon = latitudes[indices], longitudes[indices]
+        lon_extent = np.ptp(lon) * np.cos(np.radians(lat.mean()))
+        order = indices[np.argsort(lat if np.ptp(lat) >= lon_extent else lon, kind="stable")]
+        left_parts = parts // 2
+        split = int(round(len(indices) * left_parts / parts))
+        groups.append((order[:split], first_label, left_parts))
+        groups.append((order[split:], first_label + left_parts, parts - left_parts))
+    return labels
+
+def get_priority_diversity_lookup(priorities):
+    # same values as get_priority_diversity_matrix, as a table over the distinct priorities:
+    # matrix[i, j] == lookup[codes[i], codes[j]]
+    values, codes = np.unique(np.asarray(priorities), return_inverse=True)
+    lookup = get_priority_diversity_matrix(values).astype(np.float64)
+    return codes, lookup
+
+def build_sparse_similarity(distance_graph, priorities, distance_weight=0.5, priority_weight=0.5):
+    # blends the stored entries of a sparse road distance graph the same way build_clusters blends dense matrices
+    similarity = distance_graph.tocsr(copy=True).astype(np.float64)
+    rows = np.repeat(np.arange(similarity.shape[0]), np.diff(similarity.indptr))
+    codes, lookup = get_priority_diversity_lookup(priorities)
+
+    max_distance = similarity.data.max() if similarity.nnz else 1.0
+    similarity.data = (distance_weight * similarity.data / max_distance
+                       + priority_weight * lookup[codes[rows], codes[similarity.indices]])
+    return similarity
+
+def build_similarity_matrix(distance_matrix, priorities, distance_weight=0.5, priority_weight=0.5, out=None,
+                            chunk_size=1024, max_distance=None):
+    # distance_weight * normalize_matrix(D) + priority_weight * get_priority_diversity_matrix(priorities), written
+    # into `out` one block of rows at a time, so no other full-size matrix is allocated; max_distance overrides
+    # the largest value of D as the scale
+    num_packages = len(priorities)
+    codes, lookup = get_priority_diversity_lookup(priorities)
+    weighted_lookup = priority_weight * lookup
+
+    if max_distance is None:
+        max_distance = max(np.max(distance_matrix[start:start + chunk_size])
+                           for start in range(0, num_packages, chunk_size))
+    if out is None:
+        dtype = np.float32 if np.asarray(distance_matrix[:1]).dtype.itemsize <= 4 else np.float64
+        out = np.empty((num_packages, num_packages), dtype=dtype)
+
+    for start in range(0, num_packages, chunk_size):
+        stop = min(start + chunk_size, num_packages)
+        block = out[start:stop]
+        np.divide(distance_matrix[start:stop], max_distance, out=block, casting="unsafe")
+        block *= distance_weight
+        block += weighted_lookup[codes[start:stop, None], codes[None, :]]
+    return out
+
+def blend_layers(layers, weights, out=None, chunk_size=1024, maxima=None):
+    # sum of weights[i] * layers[i] / max(layers[i]) over a (layers, n, n) stack, so metres and seconds are
+    # blended on one scale (or on the given maxima); written into `out` one block of rows at a time
+    num_packages = layers.shape[1]
+    if maxima is None:
+        maxima = [max(np.max(layer[start:start + chunk_size]) for start in range(0, num_packages, chunk_size))
+                  for layer in layers]
+    scales = [weight / maximum if maximum > 0 else 0.0 for weight, maximum in zip(weights, maxima)]
+    if out is None:
+        out = np.empty((num_packages, num_packages), dtype=np.float32 if layers.dtype.itemsize <= 4 else np.float64)
+
+    for start in range(0, num_packages, chunk_size):
+        block = out[start:start + chunk_size]
+        block[...] = 0
+        for layer, scale in zip(layers, scales):
+            if scale:
+                block += scale * layer[start:start + chunk_size]
+    return out
+
+def matrix_fingerprint(matrix):
+    digest = hashlib.blake2b(digest_size=16)
+    if sparse.issparse(matrix):
+        matrix = matrix.tocsr()
+        arrays = [matrix.indptr, matrix.indices, matrix.data]
+    else:
+        arrays = [np.asarray(matrix)]
+    for array in arrays:
+        digest.update(str((array.shape, array.dtype)).encode())
+        digest.update(np.ascontiguousarray(array).view(np.uint8))
+    return digest.hexdigest()
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+
+import numpy as np
+from scipy.linalg import eigh
+from scipy.sparse.linalg import eigsh
+from sklearn.manifold import MDS
+
+from utils.distances_utils import matrix_fingerprint
+
+EMBEDDING_METHODS = ["smacof", "classical", "landmark"]
+
+# embeddings of the most recently used matrices, keyed by matrix fingerprint and embedding parameters
+_embedding_cache = OrderedDict()
+EMBEDDING_CACHE_SIZE = 8
+
+
+def symmetrize(matrix):
+    matrix = np.asarray(matrix)
+    if not np.allclose(matrix, matrix.T):
+        matrix = (matrix + matrix.T) / 2
+    return matrix
+
+
+def smacof_mds(matrix, n_components=2, random_state=42):
+    # iterative SMACOF, the embedding used before the faster backends were added
+    mds = MDS(n_components=n_components, random_state=random_state, dissimilarity="precomputed")
+    return mds.fit_transform(symmetrize(matrix))
+
+
+def _top_eigenpairs(matrix, n_components):
+    if matrix.shape[0] <= 500 or n_components >= matrix.shape[0] - 1:
+        values, vectors = eigh(matrix, subset_by_index=[matrix.shape[0] - n_components, matrix.shape[0] - 1])
+    else:
+        # truncated Lanczos decomposition, only the largest eigenpairs are computed
+        values, vectors = eigsh(matrix, k=n_components, which="LA")
+    order = np.argsort(values)[::-1]
+    return np.maximum(values[order], 0), vectors[:, order]
+
+
+def _double_centered_squares(matrix):
+    squared = np.square(matrix, dtype=np.float64)
+    row_means = squared.mean(axis=1, keepdims=True)
+    col_means = squared.mean(axis=0, keepdims=True)
+    squared -= row_means
+    squared -= col_means
+    squared += row_means.mean()
+    squared *= -0.5
+    return squared
+
+
+def classical_mds(matrix, n_components=2):
+    # Torgerson MDS: top eigenvectors of the double centred squared distances
+    values, vectors = _top_eigenpairs(_double_centered_squares(symmetrize(matrix)), n_components)
+    return vectors * np.sqrt(values)
+
+
+def landmark_mds(matrix, n_components=2, n_landmarks=200, random_state=42):
+    # classical MDS of m landmarks, every other point is placed from its distances to the landmarks only (O(n*m))
+    num_points = matrix.shape[0]
+    n_landmarks = min(n_landmarks, num_points)
+    landmarks = np.sort(np.random.RandomState(random_state).choice(num_points, n_landmarks, replace=False))
+
+    landmark_distances = (np.asarray(matrix[landmarks], dtype=np.float64)
+                          + np.asarray(matrix[:, landmarks], dtype=np.float64).T) / 2
+    landmark_squares = np.square(landmark_distances)
+    values, vectors = _top_eigenpairs(_double_centered_squares(landmark_distances[:, landmarks]), n_components)
+
+    # pseudo-inverse of the landmark embedding, guarded against zero eigenvalues
+    pseudo_inverse = vectors / np.sqrt(np.where(values > 0, values, np.inf))
+    mean_squares = np.square(landmark_distances[:, landmarks]).mean(axis=1, keepdims=True)
+    return -0.5 * (landmark_squares - mean_squares).T @ pseudo_inverse
+
+
+def _cache_key(matrix, method, n_components, random_state, n_landmarks):
+    return matrix_fingerprint(matrix), method, n_components, random_state, n_landmarks if method == "landmark" else None
+
+
+def get_cached_embedding(matrix, method="smacof", n_components=2, random_state=42, n_landmarks=200):
+    return _embedding_cache.get(_cache_key(matrix, method, n_components, random_state, n_landmarks))
+
+
+def get_embedding(matrix, method="smacof", n_components=2, random_state=42, n_landmarks=200):
+    key = _cache_key(matrix, method, n_components, random_state, n_landmarks)
+    if key in _embedding_cache:
+        _embedding_cache.move_to_end(key)
+        return _embedding_cache[key]
+
+    if method == "smacof":
+        features = smacof_mds(matrix, n_components, random_state)
+    elif method == "classical":
+        features = classical_mds(matrix, n_components)
+    elif method == "landmark":
+        features = landmark_mds(matrix, n_components, n_landmarks, random_state)
+    else:
+        raise ValueError(f"Unknown embedding method: {method}, expected one of {EMBEDDING_METHODS}")
+
+    _embedding_cache[key] = features
+    if len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+        _embedding_cache.popitem(last=False)
+    return features
@@ -0,0 +1,113 @@
+import numpy as np
+from sklearn.metrics import calinski_harabasz_score, davies_bouldin_score
+
+from utils.embedding_utils import get_embedding
+from utils.instrumentation import metrics
+
+
+def _cluster_codes(labels):
+    _, codes, counts = np.unique(np.asarray(labels), return_inverse=True, return_counts=True)
+    return codes.ravel(), counts
+
+
+def _membership(codes, n_clusters):
+    membership = np.zeros((len(codes), n_clusters))
+    membership[np.arange(len(codes)), codes] = 1
+    return membership
+
+
+def silhouette(sym_matrix, codes, counts, cluster_sums=None, sample_size=None, random_state=42):
+    # mean silhouette from per-cluster distance sums (one matrix product), optionally over a sample of rows
+    num_points = len(codes)
+    n_clusters = len(counts)
+    if not 2 <= n_clusters <= num_points - 1:
+        raise ValueError(f"Number of labels is {n_clusters}. Valid values are 2 to n_samples - 1 (inclusive)")
+
+    rows = np.arange(num_points)
+    if sample_size is not None and sample_size < num_points:
+        rows = np.sort(np.random.RandomState(random_state).choice(num_points, sample_size, replace=False))
+        cluster_sums = None
+    if cluster_sums is None:
+        cluster_sums = sym_matrix[rows] @ _membership(codes, n_clusters)
+    else:
+        cluster_sums = cluster_sums[rows]
+
+    own = codes[rows]
+    own_counts = counts[own]
+    intra = cluster_sums[np.arange(len(rows)), own] / np.maximum(own_counts - 1, 1)
+    mean_other = cluster_sums / counts
+    mean_other[np.arange(len(rows)), own] = np.inf
+    nearest_other = mean_other.min(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = (nearest_other - intra) / np.maximum(intra, nearest_other)
+    # points alone in their cluster score 0
+    scores = np.where(own_counts > 1, np.nan_to_num(scores), 0)
+    return float(scores.mean())
+
+
+def medoid_scores(sym_matrix, codes, counts, cluster_sums):
+    # Calinski-Harabasz and Davies-Bouldin with cluster medoids in place of centroids, no embedding needed
+    num_points = len(codes)
+    n_clusters = len(counts)
+    own_sums = np.where(_membership(codes, n_clusters) > 0, cluster_sums, np.inf)
+    medoids = own_sums.argmin(axis=0)
+    overall_medoid = int(cluster_sums.sum(axis=1).argmin())
+
+    to_medoid = sym_matrix[np.arange(num_points), medoids[codes]]
+    within = float(np.sum(to_medoid ** 2))
+    between = float(np.sum(counts * sym_matrix[medoids, overall_medoid] ** 2))
+    ch_score = (between * (num_points - n_clusters)) / (within * (n_clusters - 1)) if within > 0 else 1.0
+
+    scatter = np.bincount(codes, weights=to_medoid, minlength=n_clusters) / counts
+    medoid_distances = sym_matrix[np.ix_(medoids, medoids)].astype(np.float64)
+    # like sklearn, coinciding centres (and a cluster with itself) do not contribute
+    medoid_distances[medoid_distances == 0] = np.inf
+    ratios = (scatter[:, None] + scatter[None, :]) / medoid_distances
+    db_score = float(ratios.max(axis=1).mean())
+    return ch_score, db_score
+
+
+def intra_cluster_distances(sym_matrix, codes):
+    # sum of distances between consecutive packages of a cluster, in the order of package indices
+    order = np.argsort(codes, kind="stable")
+    origins, destinations = order[:-1], order[1:]
+    same_cluster = codes[origins] == codes[destinations]
+    return float(sym_matrix[origins[same_cluster], destinations[same_cluster]].sum())
+
+
+@metrics.span("evaluate")
+def evaluate_clusters(distance_matrix, labels, ch_db="medoid", embedding_method="smacof", silhouette_sample_size=None,
+                      random_state=42):
+    # ch_db="medoid" scores CH/DB on the matrix itself, ch_db="embedding" on a (cached) MDS embedding of it
+    distance_matrix = np.asarray(distance_matrix)
+    sym_matrix = (distance_matrix + distance_matrix.T) / 2  # ensure symmetry
+    codes, counts = _cluster_codes(labels)
+
+    cluster_sums = None
+    if ch_db == "medoid" or silhouette_sample_size is None:
+        cluster_sums = sym_matrix @ _membership(codes, len(counts))
+
+    silhouette_score = silhouette(sym_matrix, codes, counts, cluster_sums, silhouette_sample_size, random_state)
+
+    if ch_db == "medoid":
+        ch_score, db_score = medoid_scores(sym_matrix, codes, counts, cluster_sums)
+    elif ch_db == "embedding":
+        features = get_embedding(sym_matrix, method=embedding_method, random_state=random_state)
+        ch_score = calinski_harabasz_score(features, codes)
+        db_score = davies_bouldin_score(features, codes)
+    else:
+        raise ValueError(f"Unknown ch_db method: {ch_db}, expected 'medoid' or 'embedding'")
+
+    # Load balance: how similar cluster sizes are
+    load_std = np.std(counts)  # smaller = more balanced
+    load_mean = np.mean(counts)
+    load_balance = 1 - (load_std / load_mean) if load_mean > 0 else 0  # normalized 0-1
+
+    return {
+        "silhouette": round(silhouette_score, 3),
+        "calinski_harabasz": round(float(ch_score), 3),
+        "davies_bouldin": round(float(db_score), 3),
+        "load_balance": round(float(load_balance), 3),
+        "sum_intra_cluster_distances": round(intra_cluster_distances(sym_matrix, codes) / 1000.0, 3)
+    }
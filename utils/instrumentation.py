@@ -0,0 +1,105 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows, memory is then not sampled
+    resource = None
+
+def peak_rss_bytes(who=None):
+    # peak resident set size of the process so far, or of its finished child processes with
+    # who=resource.RUSAGE_CHILDREN (ru_maxrss is in kilobytes on Linux)
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss * 1024
+
+
+class Metrics:
+    # timing spans per pipeline stage (load, fetch, fetch_submit, fetch_poll, fetch_download, assemble, normalize,
+    # fit, evaluate, render), counters and peak memory of one process; thread safe, so the fetch threads of
+    # ClusterManager record into the same registry. span() also works as a function decorator
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # stage -> [calls, total seconds, longest call in seconds, largest rise of the peak RSS in bytes]
+            self.spans = {}
+            self.counters = {}
+            self.started = time.time()
+
+    @contextmanager
+    def span(self, stage):
+        peak_before = peak_rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            peak_rise = peak_rss_bytes() - peak_before
+            with self.lock:
+                stats = self.spans.setdefault(stage, [0, 0.0, 0.0, 0])
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+                stats[3] = max(stats[3], peak_rise)
+
+    def increment(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptime_seconds": round(time.time() - self.started, 3),
+                "peak_rss_bytes": peak_rss_bytes(),
+                "children_peak_rss_bytes": peak_rss_bytes(resource.RUSAGE_CHILDREN) if resource is not None else 0,
+                "stages": {stage: {"calls": calls, "seconds": round(total, 6), "max_seconds": round(longest, 6),
+                                   "peak_rss_rise_bytes": peak_rise}
+                           for stage, (calls, total, longest, peak_rise) in self.spans.items()},
+                "counters": dict(self.counters),
+            }
+
+    def merge(self, snapshot):
+        # adds the spans and counters of another registry's snapshot, e.g. one returned by a worker process
+        with self.lock:
+            for stage, stats in snapshot["stages"].items():
+                merged = self.spans.setdefault(stage, [0, 0.0, 0.0, 0])
+                merged[0] += stats["calls"]
+                merged[1] += stats["seconds"]
+                merged[2] = max(merged[2], stats["max_seconds"])
+                merged[3] = max(merged[3], stats["peak_rss_rise_bytes"])
+            for counter, value in snapshot["counters"].items():
+                self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, prefix="clustering"):
+        snapshot = self.snapshot()
+        lines = []
+        for gauge in ["peak_rss_bytes", "children_peak_rss_bytes"]:
+            lines += [f"# TYPE {prefix}_{gauge} gauge", f"{prefix}_{gauge} {snapshot[gauge]}"]
+        for metric, key, kind in [("stage_calls_total", "calls", "counter"),
+                                  ("stage_seconds_total", "seconds", "counter"),
+                                  ("stage_max_seconds", "max_seconds", "gauge"),
+                                  ("stage_peak_rss_rise_bytes", "peak_rss_rise_bytes", "gauge")]:
+            lines.append(f"# TYPE {prefix}_{metric} {kind}")
+            lines += [f'{prefix}_{metric}{{stage="{stage}"}} {stats[key]}'
+                      for stage, stats in snapshot["stages"].items()]
+        for counter, value in snapshot["counters"].items():
+            lines += [f"# TYPE {prefix}_{counter}_total counter", f"{prefix}_{counter}_total {value}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # Prometheus text for .prom/.txt files, JSON otherwise
+        text = self.to_prometheus() if path.endswith((".prom", ".txt")) else self.to_json()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+# registry shared by the whole pipeline
+metrics = Metrics()
@@ -0,0 +1,99 @@
+import json
+import os
+
+import numpy as np
+
+
+# Distance matrix kept in a memory-mapped .npy file, together with the ids of the packages on its rows, so a matrix
+# fetched once can be reopened by later runs without loading it into memory.
+class MatrixStore:
+    def __init__(self, path, dtype="float32"):
+        # uint32 holds road distances in whole metres, float32 also fits normalised values
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.metadata_path = f"{path}.json"
+        # chunks of an unfinished build, one JSON line per chunk after a header line
+        self.checkpoint_path = f"{path}.chunks.jsonl"
+
+    def exists(self):
+        return os.path.exists(self.path) and os.path.exists(self.metadata_path)
+
+    def create(self, shape):
+        # the new file replaces the old one only by rename, so a matrix that is still mapped stays readable
+        temporary_path = f"{self.path}.tmp.npy"
+        matrix = np.lib.format.open_memmap(temporary_path, mode="w+", dtype=self.dtype, shape=shape)
+        os.replace(temporary_path, self.path)
+        if os.path.exists(self.metadata_path):
+            os.remove(self.metadata_path)
+        return matrix
+
+    def open(self, mode="r+"):
+        return np.lib.format.open_memmap(self.path, mode=mode)
+
+    def save(self, matrix, package_ids, layers=None, window_gap=None):
+        # layers: names of the matrices along the first axis of a stacked (layers, n, n) matrix; window_gap: the
+        # matrix only holds the pairs of compatible delivery windows (ClusterManager.build_windowed_distance_matrix)
+        if isinstance(matrix, np.memmap):
+            matrix.flush()
+        metadata = {"dtype": str(matrix.dtype), "package_ids": [str(i) for i in package_ids]}
+        if layers is not None:
+            metadata["layers"] = list(layers)
+        if window_gap is not None:
+            metadata["window_gap"] = window_gap
+        with open(self.metadata_path, "w", encoding="utf-8") as f:
+            json.dump(metadata, f)
+
+    def _metadata(self):
+        with open(self.metadata_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def get_package_ids(self):
+        return self._metadata()["package_ids"]
+
+    def matches(self, package_ids, layers=None, window_gap=None):
+        # a pruned matrix never stands in for a full one, or for one pruned with another gap
+        if not self.exists():
+            return False
+        metadata = self._metadata()
+        return (metadata["package_ids"] == [str(i) for i in package_ids]
+                and (layers is None or metadata.get("layers") == list(layers))
+                and metadata.get("window_gap") == window_gap)
+
+    def start_checkpoint(self, package_ids, layout):
+        # layout: whatever determines the chunks of the build (e.g. the cell limit they were planned with)
+        with open(self.checkpoint_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"package_ids": [str(i) for i in package_ids], "layout": layout}) + "\n")
+
+    def load_checkpoint(self, package_ids, layout):
+        # (row offset, column offset) of every chunk an unfinished build for the same packages and chunk layout
+        # has written, None when there is no such build
+        if not os.path.exists(self.checkpoint_path) or not os.path.exists(self.path):
+            return None
+        with open(self.checkpoint_path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            return None
+        if header["package_ids"] != [str(i) for i in package_ids] or header.get("layout") != layout:
+            return None
+
+        completed = set()
+        for line in lines[1:]:
+            try:
+                completed.add(tuple(json.loads(line)))
+            except ValueError:
+                # the last line may be cut off when the process died while writing it
+                continue
+        return completed
+
+    def record_chunk(self, matrix, row_offset, col_offset):
+        # the chunk is on disk before the manifest says so
+        if isinstance(matrix, np.memmap):
+            matrix.flush()
+        with open(self.checkpoint_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps([row_offset, col_offset]) + "\n")
+
+    def clear_checkpoint(self):
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
@@ -0,0 +1,167 @@
+import csv
+import hashlib
+import itertools
+import logging
+import os
+
+import numpy as np
+
+from data_models.package_store import NO_TIME, PackageList, PackageStore, to_minutes
+from utils.instrumentation import metrics
+
+REQUIRED_COLUMNS = ["id", "lat", "lon"]
+# optional columns and the value of rows (or whole files) that do not have them
+OPTIONAL_COLUMNS = {"priority": 0, "opening_hour": "", "closing_hour": "", "cluster": -1}
+# priority of a malformed cell, such rows are skipped
+INVALID_PRIORITY = np.iinfo(np.int8).min
+CACHE_VERSION = 2
+
+logger = logging.getLogger(__name__)
+
+
+def file_hash(path, block_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def sidecar_path(csv_file):
+    return f"{csv_file}.packages.npz"
+
+
+def _to_numbers(values, dtype, default, count, invalid=np.nan):
+    # one vectorised conversion, value by value only when the chunk has empty or malformed cells; empty cells
+    # get the default and malformed ones `invalid`
+    if values is None:
+        return np.full(count, default, dtype=dtype)
+    try:
+        return np.array(values, dtype=np.float64).astype(dtype)
+    except ValueError:
+        numbers = np.empty(len(values), dtype=np.float64)
+        for i, value in enumerate(values):
+            try:
+                numbers[i] = float(value) if value.strip() else default
+            except ValueError:
+                numbers[i] = invalid
+        return numbers if dtype == np.float64 else np.nan_to_num(numbers, nan=default).astype(dtype)
+
+
+def _to_minutes(values, count):
+    # time windows take few distinct values, each is parsed once; -2 marks a malformed one
+    if values is None:
+        return np.full(count, NO_TIME, dtype=np.int16)
+    distinct, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+    minutes = np.empty(len(distinct), dtype=np.int16)
+    for i, value in enumerate(distinct):
+        try:
+            minutes[i] = to_minutes(value.strip())
+        except ValueError:
+            minutes[i] = -2
+    return minutes[inverse]
+
+
+def _read_chunks(csv_file, chunk_size):
+    # typed columns of `chunk_size` rows at a time, the file is never held in memory as rows
+    with open(csv_file, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = [name.strip() for name in next(reader, [])]
+        missing = [name for name in REQUIRED_COLUMNS if name not in header]
+        if missing:
+            raise ValueError(f"{csv_file} is missing the required columns {missing}")
+        positions = {name: header.index(name) for name in REQUIRED_COLUMNS + list(OPTIONAL_COLUMNS) if name in header}
+
+        while True:
+            rows = [row for row in itertools.islice(reader, chunk_size) if row]
+            if not rows:
+                break
+            # a missing trailing cell of a short row reads as empty
+            columns = list(itertools.zip_longest(*rows, fillvalue=""))
+            count = len(rows)
+
+            def column(name):
+                return columns[positions[name]] if name in positions else None
+
+            yield {
+                "ids": np.array([value.strip() for value in column("id")], dtype=object),
+                "latitude": _to_numbers(column("lat"), np.float64, np.nan, count),
+                "longitude": _to_numbers(column("lon"), np.float64, np.nan, count),
+                "priority": _to_numbers(column("priority"), np.int8, OPTIONAL_COLUMNS["priority"], count,
+                                        INVALID_PRIORITY),
+                "opening_minutes": _to_minutes(column("opening_hour"), count),
+                "closing_minutes": _to_minutes(column("closing_hour"), count),
+                "cluster": _to_numbers(column("cluster"), np.int32, OPTIONAL_COLUMNS["cluster"], count),
+            }
+
+
+def parse_packages(csv_file, chunk_size=100_000):
+    # columns of every valid package of the file; rows with a missing id, coordinates outside the globe, a
+    # malformed priority or time window are skipped, as are repeated ids (the first row of an id wins). Distinct
+    # packages at the same coordinates are kept, ClusterManager requests every coordinate once per matrix job
+    chunks = list(_read_chunks(csv_file, chunk_size))
+    if not chunks:
+        columns = {name: np.empty(0, dtype=dtype) for name, dtype in PackageStore.COLUMNS.items()}
+        return {"ids": np.empty(0, dtype=object), **columns}, 0, 0
+    columns = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+
+    valid = ((columns["ids"] != "")
+             & np.isfinite(columns["latitude"]) & (np.abs(columns["latitude"]) <= 90)
+             & np.isfinite(columns["longitude"]) & (np.abs(columns["longitude"]) <= 180)
+             & (columns["priority"] != INVALID_PRIORITY)
+             & (columns["opening_minutes"] >= NO_TIME) & (columns["closing_minutes"] >= NO_TIME))
+    valid_rows = np.flatnonzero(valid)
+    _, first = np.unique(columns["ids"][valid_rows].astype(str), return_index=True)
+    kept = valid_rows[np.sort(first)]
+
+    num_invalid = len(valid) - len(valid_rows)
+    num_duplicates = len(valid_rows) - len(kept)
+    return {name: values[kept] for name, values in columns.items()}, num_invalid, num_duplicates
+
+
+def _load_sidecar(csv_file, stat):
+    path = sidecar_path(csv_file)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as sidecar:
+        if int(sidecar["version"]) != CACHE_VERSION:
+            return None
+        # the content hash is only recomputed when the file looks modified
+        if (int(sidecar["size"]), int(sidecar["mtime_ns"])) != (stat.st_size, stat.st_mtime_ns) \
+                and str(sidecar["hash"]) != file_hash(csv_file):
+            return None
+        columns = {name: sidecar[name] for name in PackageStore.COLUMNS}
+        # fixed-width strings, converted once when they are copied into the store
+        columns["ids"] = sidecar["ids"]
+    return columns
+
+
+def _save_sidecar(csv_file, stat, columns):
+    path = sidecar_path(csv_file)
+    temporary_path = f"{path}.tmp.npz"
+    np.savez(temporary_path, version=CACHE_VERSION, hash=file_hash(csv_file), size=stat.st_size,
+             mtime_ns=stat.st_mtime_ns, ids=columns["ids"].astype(str),
+             **{name: columns[name] for name in PackageStore.COLUMNS})
+    os.replace(temporary_path, path)
+
+
+def load_packages(csv_file, store: PackageStore = None, chunk_size=100_000, use_cache=True) -> PackageList:
+    # packages of a CSV file (id, lat, lon and optionally priority, opening_hour, closing_hour, cluster) as views
+    # of a PackageStore; the parsed columns are cached next to the file and reused while its content is unchanged
+    with metrics.span("load"):
+        stat = os.stat(csv_file)
+        columns = _load_sidecar(csv_file, stat) if use_cache else None
+        if columns is None:
+            columns, num_invalid, num_duplicates = parse_packages(csv_file, chunk_size)
+            if num_invalid or num_duplicates:
+                logger.warning("%s: skipped %d invalid and %d duplicate rows", csv_file, num_invalid, num_duplicates)
+            if use_cache:
+                _save_sidecar(csv_file, stat, columns)
+        else:
+            logger.debug("%s: packages read from %s", csv_file, sidecar_path(csv_file))
+
+        store = PackageStore(capacity=max(len(columns["ids"]), 1)) if store is None else store
+        indices = store.add_many(columns["ids"], columns["latitude"], columns["longitude"], columns["priority"],
+                                 columns["opening_minutes"], columns["closing_minutes"], columns["cluster"])
+    metrics.increment("packages_loaded", len(indices))
+    return store.view(indices)
@@ -0,0 +1,28 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Progress:
+    # "done/total" with elapsed time and an ETA from the average pace so far, logged at most every
+    # `interval` seconds and once more when the last item is done
+    def __init__(self, label, total, interval=5.0):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.started = time.perf_counter()
+        self.last_report = self.started
+
+    def eta(self):
+        elapsed = time.perf_counter() - self.started
+        return elapsed / self.done * (self.total - self.done) if self.done else float("nan")
+
+    def update(self, count=1):
+        self.done += count
+        now = time.perf_counter()
+        if self.done >= self.total or now - self.last_report >= self.interval:
+            self.last_report = now
+            logger.info("%s: %d/%d (%.0f%%), %.1f s elapsed, ETA %.1f s", self.label, self.done, self.total,
+                        100 * self.done / max(self.total, 1), now - self.started, self.eta())
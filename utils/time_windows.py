@@ -0,0 +1,34 @@
+import numpy as np
+
+from data_models.package_store import NO_TIME
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def window_intervals(opening_minutes, closing_minutes):
+    # (start, end) in minutes of every delivery window; a missing bound is open-ended (no window at all is
+    # compatible with every other package) and a window that closes before it opens runs past midnight
+    opening = np.asarray(opening_minutes, dtype=np.float64)
+    closing = np.asarray(closing_minutes, dtype=np.float64)
+    has_opening, has_closing = opening != NO_TIME, closing != NO_TIME
+    closing = np.where(has_opening & has_closing & (closing < opening), closing + MINUTES_PER_DAY, closing)
+    return np.where(has_opening, opening, -np.inf), np.where(has_closing, closing, np.inf)
+
+
+def compatible_windows(starts_a, ends_a, starts_b, ends_b, max_gap=0):
+    # (len(a), len(b)) mask of pairs whose windows overlap or lie at most max_gap minutes apart, so that one
+    # route can serve both
+    return (starts_a[:, None] <= ends_b[None, :] + max_gap) & (starts_b[None, :] <= ends_a[:, None] + max_gap)
+
+
+def window_components(starts, ends, max_gap=0):
+    # groups of packages chained by compatible windows, no pair across two groups is compatible: sweeping the
+    # windows by start, a group ends where the next window opens more than max_gap after all earlier ones closed
+    if len(starts) == 0:
+        return np.empty(0, dtype=np.intp)
+    order = np.argsort(starts, kind="stable")
+    running_end = np.maximum.accumulate(ends[order])
+    breaks = starts[order][1:] > running_end[:-1] + max_gap
+    components = np.empty(len(starts), dtype=np.intp)
+    components[order] = np.concatenate([[0], np.cumsum(breaks)])
+    return components